@@ -0,0 +1,79 @@
+# AUTOTUNE.py
+# Relay feedback autotuning of the heater PID loop and gain schedules across
+# the sweep range
+import math
+import time
+import cPickle as pickle
+
+import numpy
+
+# (KP, integral time, derivative time) from the ultimate gain Ku and period Pu.
+# Tyreus-Luyben trades speed for much less overshoot than Ziegler-Nichols.
+tuning_rules = {
+    "ziegler-nichols": lambda Ku, Pu: (0.6*Ku, Pu/2.0, Pu/8.0),
+    "no-overshoot": lambda Ku, Pu: (0.2*Ku, Pu/2.0, Pu/3.0),
+    "tyreus-luyben": lambda Ku, Pu: (Ku/2.2, 2.2*Pu, Pu/6.3),
+}
+
+def relay_autotune(read_temperature, set_power, setpoint, bias, amplitude, hysteresis = 0.02, \
+                   cycles = 3, period = 0.5, timeout = 1800):
+    """Switches the heater between bias + amplitude and bias - amplitude whenever
+    the temperature crosses setpoint, and returns the ultimate gain (W/K) and
+    period (s) of the resulting oscillation. bias should be close to the power
+    that holds setpoint."""
+    start = time.time()
+    high = True
+    set_power(bias + amplitude)
+    switches = []
+    samples = []
+    while len(switches) < 2*cycles + 2:
+        if time.time() - start > timeout:
+            raise RuntimeError("relay autotune at {t} K did not oscillate".format(t = setpoint))
+        T = read_temperature()
+        now = time.time()
+        samples.append((now, T))
+        if high and T > setpoint + hysteresis:
+            high = False
+            set_power(bias - amplitude)
+            switches.append(now)
+        elif not high and T < setpoint - hysteresis:
+            high = True
+            set_power(bias + amplitude)
+            switches.append(now)
+        time.sleep(period)
+    set_power(bias)
+
+    # the first cycle starts away from the setpoint, only use the later ones
+    settled = switches[2:]
+    Pu = numpy.mean(numpy.diff(settled[::2]))
+    temperatures = numpy.array([T for t, T in samples if t >= settled[0]])
+    a = (temperatures.max() - temperatures.min())/2.0
+    if a <= hysteresis:
+        raise RuntimeError("relay autotune at {t} K oscillated within the hysteresis".format(t = setpoint))
+    # describing function of a relay with hysteresis
+    Ku = 4*amplitude/(math.pi*math.sqrt(a**2 - hysteresis**2))
+    return Ku, Pu
+
+def gains_from_ultimate(Ku, Pu, rule = "tyreus-luyben"):
+    """Returns the (KP, KI, KD) for pid.PIDController"""
+    KP, Ti, Td = tuning_rules[rule](Ku, Pu)
+    return KP, KP/Ti, KP*Td
+
+class GainSchedule(object):
+    """PID gains identified at a set of temperatures, interpolated in between"""
+    def __init__(self, entries = None):
+        self.entries = sorted(entries or [])
+
+    def add(self, temperature, gains):
+        self.entries = sorted([e for e in self.entries if e[0] != temperature] + [(temperature, tuple(gains))])
+
+    def gains(self, temperature):
+        temperatures = [e[0] for e in self.entries]
+        return tuple(numpy.interp(temperature, temperatures, [e[1][i] for e in self.entries]) for i in range(3))
+
+    def save(self, path):
+        pickle.dump(self.entries, open(path, 'wb+'))
+
+    @classmethod
+    def load(cls, path):
+        return cls(pickle.load(open(path, 'rb')))
@@ -0,0 +1,170 @@
+# CATALOG.py
+# Index of the run directories with their time span, setpoint range, settings,
+# point count and completion status, so runs can be found without unpickling them
+import os
+import re
+import sys
+import json
+import time
+import threading
+from datetime import datetime
+
+import runstore
+import checkpoint
+
+catalog_file = "CATALOG" # one per directory of runs
+info_file = "RUNINFO" # one per run directory
+
+# the CATALOG is rewritten by every run in the same directory
+catalog_lock = threading.Lock()
+
+def point_temperatures(point):
+    point = runstore.normalize_record(point)
+    return [v for k, v in point.items() if re.match(r'^Temperature\d*$', k)]
+
+def point_frequencies(point):
+    """Drive frequencies (kHz) with a lock-in reading in a data point"""
+    point = runstore.normalize_record(point)
+    return sorted(int(k[1:]) for k in point if re.match(r'^R\d+$', k))
+
+def write_json(path, value):
+    checkpoint.replace_file(path, json.dumps(value, indent = 1, sort_keys = True), 'w')
+
+def read_catalog(root):
+    """Entries of the CATALOG in root by run directory name, empty if there is none"""
+    path = os.path.join(root, catalog_file)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def update_catalog(root, entries):
+    with catalog_lock:
+        catalog = read_catalog(root)
+        catalog.update(entries)
+        write_json(os.path.join(root, catalog_file), catalog)
+
+class RunEntry(object):
+    """Catalog entry of a run in progress, written to RUNINFO in the run directory
+    and to the CATALOG next to it as points are recorded. A resumed run keeps its
+    original start time."""
+    def __init__(self, base_directory, kind, setpoint_range, setpoint_step, settings, \
+                 frequencies = (), resume = False, save_interval = 30):
+        self.path = os.path.abspath(base_directory)
+        self.save_interval = save_interval
+        self.last_save = 0
+        start_time = datetime.now().isoformat()
+        info_path = os.path.join(self.path, info_file)
+        if resume and os.path.exists(info_path):
+            with open(info_path) as f:
+                start_time = json.load(f)["start_time"]
+        self.info = {"name": os.path.basename(self.path), "path": self.path, "kind": kind, \
+                     "start_time": start_time, "end_time": None, \
+                     "setpoint_min": setpoint_range[0], "setpoint_max": setpoint_range[1], \
+                     "setpoint_step": setpoint_step, \
+                     "temperature_min": None, "temperature_max": None, \
+                     "frequencies": sorted(frequencies), "settings": settings, "points": 0, "complete": False}
+
+    def add_point(self, point):
+        """Counts a recorded point, saving at most every save_interval seconds"""
+        temperatures = point_temperatures(point)
+        if self.info["temperature_min"] is not None:
+            temperatures += [self.info["temperature_min"], self.info["temperature_max"]]
+        self.info["temperature_min"] = min(temperatures)
+        self.info["temperature_max"] = max(temperatures)
+        self.info["frequencies"] = sorted(set(self.info["frequencies"]) | set(point_frequencies(point)))
+        self.info["points"] += 1
+        if time.time() - self.last_save >= self.save_interval:
+            self.save()
+
+    def finish(self):
+        self.info["end_time"] = datetime.now().isoformat()
+        self.info["complete"] = True
+        self.save()
+
+    def save(self):
+        self.info["updated"] = datetime.now().isoformat()
+        write_json(os.path.join(self.path, info_file), self.info)
+        update_catalog(os.path.dirname(self.path), {self.info["name"]: self.info})
+        self.last_save = time.time()
+
+def index_run(run_directory):
+    """Catalog entry of an existing run directory. Runs that wrote a RUNINFO use
+    it; older ones are summarized from their data, with the times taken from the
+    files and the setpoints from the first temperature of each point."""
+    run_directory = os.path.abspath(run_directory)
+    info_path = os.path.join(run_directory, info_file)
+    if os.path.exists(info_path):
+        with open(info_path) as f:
+            return json.load(f)
+
+    records = runstore.load_records(run_directory)
+    final_path = os.path.join(run_directory, "FINALDATA")
+    files = [final_path] if os.path.exists(final_path) else []
+    inter_directory = os.path.join(run_directory, "TEMP")
+    if os.path.exists(inter_directory):
+        files += [os.path.join(inter_directory, name) for name in os.listdir(inter_directory)]
+    times = [os.path.getmtime(f) for f in files]
+
+    kind = "ramp" if records and "Time" in records[0] else "step"
+    if kind == "ramp":
+        setpoints = [r["Setpoint"] for r in records]
+    else:
+        setpoints = [runstore.first_temperature(r) for r in records]
+    temperatures = [t for r in records for t in point_temperatures(r)]
+    frequencies = set()
+    for r in records:
+        frequencies.update(point_frequencies(r))
+    steps = sorted(b - a for a, b in zip(setpoints, setpoints[1:]))
+    return {"name": os.path.basename(run_directory), "path": run_directory, "kind": kind, \
+            "start_time": datetime.fromtimestamp(min(times)).isoformat() if times else None, \
+            "end_time": datetime.fromtimestamp(max(times)).isoformat() if times and files[0] == final_path else None, \
+            "setpoint_min": min(setpoints) if setpoints else None, \
+            "setpoint_max": max(setpoints) if setpoints else None, \
+            "setpoint_step": round(steps[len(steps)//2], 3) if steps else None, \
+            "temperature_min": min(temperatures) if temperatures else None, \
+            "temperature_max": max(temperatures) if temperatures else None, \
+            "frequencies": sorted(frequencies), "settings": {}, "points": len(records), \
+            "complete": os.path.exists(final_path)}
+
+def is_run_directory(path):
+    return os.path.exists(os.path.join(path, "FINALDATA")) or os.path.exists(os.path.join(path, "TEMP"))
+
+def index_directory(root):
+    """Catalogs every run directory in root and returns the entries"""
+    entries = {}
+    for name in sorted(os.listdir(root)):
+        path = os.path.join(root, name)
+        if os.path.isdir(path) and is_run_directory(path):
+            entries[name] = index_run(path)
+    update_catalog(root, entries)
+    return entries
+
+def find_runs(root, complete = None, covering = None, frequency = None, kind = None, min_points = 0):
+    """Catalog entries in root, oldest first, that match every given condition:
+    completion status, a (low, high) temperature range lying within the measured
+    temperatures, a drive frequency (kHz), the kind of run ("step" or "ramp")
+    and a minimum number of points"""
+    runs = []
+    for entry in read_catalog(root).values():
+        if complete is not None and entry["complete"] != complete:
+            continue
+        if covering is not None and (entry["temperature_min"] is None or \
+                                     entry["temperature_min"] > covering[0] or entry["temperature_max"] < covering[1]):
+            continue
+        if frequency is not None and frequency not in entry["frequencies"]:
+            continue
+        if kind is not None and entry["kind"] != kind:
+            continue
+        if entry["points"] < min_points:
+            continue
+        runs.append(entry)
+    return sorted(runs, key = lambda entry: entry["start_time"])
+
+if __name__ == "__main__":
+    # catalog.py DIRECTORY_OF_RUNS ...
+    for root in sys.argv[1:]:
+        for name, entry in sorted(index_directory(root).items()):
+            print "{n}: {p} points, {a} - {b} K, {c}".format(n = name, p = entry["points"], \
+                a = entry["temperature_min"], b = entry["temperature_max"], \
+                c = "complete" if entry["complete"] else "incomplete")
@@ -0,0 +1,71 @@
+# CHECKPOINT.py
+# Append-only checkpoint log for a run: one fsync'd record per data point
+import os
+import struct
+import zlib
+import cPickle as pickle
+
+# every record is a fixed header (payload length, crc32 of payload) followed by
+# a pickled (point, state) pair
+header = struct.Struct("<II")
+
+class CheckpointWriter(object):
+    """Appends data points to a single per-run log file"""
+    def __init__(self, path, truncate = True):
+        self.path = path
+        if truncate or not os.path.exists(path):
+            self.file = open(path, 'wb')
+        else:
+            # drop a torn last record so new records stay readable
+            records, end = scan(path)
+            self.file = open(path, 'r+b')
+            self.file.truncate(end)
+            self.file.seek(end)
+
+    def append(self, point, state = None):
+        payload = pickle.dumps((point, state), pickle.HIGHEST_PROTOCOL)
+        crc = zlib.crc32(payload) & 0xffffffff
+        self.file.write(header.pack(len(payload), crc) + payload)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+def scan(path):
+    """Returns the (point, state) pairs in the log and the offset just past the
+    last intact record, stopping at the first torn or corrupted record"""
+    records = []
+    end = 0
+    if not os.path.exists(path):
+        return records, end
+    with open(path, 'rb') as f:
+        while True:
+            head = f.read(header.size)
+            if len(head) < header.size:
+                break
+            length, crc = header.unpack(head)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                break
+            records.append(pickle.loads(payload))
+            end = f.tell()
+    return records, end
+
+def read_records(path):
+    return scan(path)[0]
+
+def replace_file(path, data, mode = 'wb'):
+    """Writes data to a new file and renames it over path, so a crash or a
+    reader never sees a torn file"""
+    temporary_path = path + ".new"
+    with open(temporary_path, mode) as f:
+        f.write(data)
+    if os.name == 'nt' and os.path.exists(path):
+        # rename does not replace an existing file on Windows
+        os.remove(path)
+    os.rename(temporary_path, path)
+
+def read_checkpoint(path):
+    """Rebuilds the data list from a checkpoint log"""
+    return [point for point, state in read_records(path)]
@@ -0,0 +1,93 @@
+# ESTIMATOR.py
+# Kalman filter for the stage temperature and its rate of change, driven by the
+# heater power, which sits between the thermometer and the PID controller
+import math
+import time
+
+import numpy
+
+class TemperatureEstimator(object):
+    """Kalman filter for the temperature and rate of the stage on the wall clock.
+    The rate relaxes with time constant lag (s) towards (P - hold_power(T))/C,
+    the rate at which the heater power P warms the stage past the power that
+    would hold it at T. hold_power is a function of temperature such as
+    HoldPowerMap.predict and may return None. Unless heat_capacity C (J/K) is
+    given, 1/C is a third state, learned as the filter runs (an extended Kalman
+    filter) from prior_gain +- gain_spread. Without a hold power the rate is a
+    random walk, wandering with spectral density unmodelled_noise (K^2/s^3)
+    rather than the process_noise left by the model. Each reading scatters by
+    measurement_noise (K) unless the thermometer reports its own."""
+    def __init__(self, measurement_noise = 0.01, process_noise = 1e-5, unmodelled_noise = 1e-3, lag = 4.0, \
+                 hold_power = None, heat_capacity = None, prior_gain = 0.0, gain_spread = 5.0, gain_drift = 1e-6):
+        self.measurement_noise = measurement_noise
+        self.process_noise = process_noise
+        self.unmodelled_noise = unmodelled_noise
+        self.lag = lag
+        self.hold_power = hold_power
+        self.heat_capacity = heat_capacity
+        self.prior_gain = prior_gain
+        self.gain_spread = gain_spread
+        self.gain_drift = gain_drift
+        self.reset()
+
+    def reset(self):
+        self.x = None
+        self.P = None
+        self.last = None
+        self.power = None
+
+    def gain(self):
+        """Heating rate per watt of excess power (K/J)"""
+        if self.heat_capacity is not None:
+            return 1.0/self.heat_capacity
+        return self.x[2] if self.x is not None else self.prior_gain
+
+    def excess_power(self, temperature):
+        if self.power is None or self.hold_power is None:
+            return None
+        hold = self.hold_power(temperature)
+        if hold is None:
+            return None
+        return self.power - hold
+
+    def predict(self, now):
+        dt = max(now - self.last, 0.0)
+        excess = self.excess_power(self.x[0])
+        if excess is None:
+            F = numpy.array([[1.0, dt, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]])
+            q = self.unmodelled_noise
+        else:
+            decay = math.exp(-dt/self.lag)
+            # the gain multiplies the excess power, so F is the Jacobian in it
+            F = numpy.array([[1.0, self.lag*(1 - decay), (dt - self.lag*(1 - decay))*excess], \
+                             [0.0, decay, (1 - decay)*excess], [0.0, 0.0, 1.0]])
+            q = self.process_noise
+        Q = numpy.zeros((3, 3))
+        Q[:2, :2] = q*numpy.array([[dt**3/3, dt**2/2], [dt**2/2, dt]])
+        if self.heat_capacity is None:
+            Q[2, 2] = self.gain_drift*dt
+        self.x = F.dot(self.x)
+        self.P = F.dot(self.P).dot(F.T) + Q
+        self.last = now
+
+    def update(self, measured, now = None, noise = None):
+        """Folds in a reading taken at now and returns the filtered (temperature,
+        rate in K/s)"""
+        if now is None:
+            now = time.time()
+        R = (noise if noise else self.measurement_noise)**2
+        if self.x is None:
+            known = self.heat_capacity is not None
+            self.x = numpy.array([measured, 0.0, 1.0/self.heat_capacity if known else self.prior_gain])
+            self.P = numpy.diag([R, 1.0, 0.0 if known else self.gain_spread**2])
+            self.last = now
+            return measured, 0.0
+        self.predict(now)
+        K = self.P[:, 0]/(self.P[0, 0] + R)
+        self.x = self.x + K*(measured - self.x[0])
+        self.P = self.P - numpy.outer(K, self.P[0])
+        return self.x[0], self.x[1]
+
+    def set_power(self, power):
+        """Records the heater power applied from now until the next update"""
+        self.power = power
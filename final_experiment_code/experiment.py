@@ -1,12 +1,24 @@
 import sys, os
+import copy
+import threading
 import cPickle as pickle
 from datetime import datetime
 import time
 
-import visa
-
 import instruments
 import pid
+import checkpoint
+import scheduler
+import settling
+import autotune
+import holdpower
+import ramp
+import runstore
+import catalog
+import tracing
+import telemetry
+import planner as setpoint_planner
+import estimator
 
 
 heater = None
@@ -17,89 +29,58 @@ source_meter = None
 therm_multimeter = None
 drive_multimeter = None
 lock_in = None
+instrument_scheduler = None
 
 data = []
 
 drive_resistor = 98.8
 
-def setupExperiment():
-    global rm
-    global source_meter
-    global heater
-    global drive_FG
-    global therm_multimeter
-    global thermometer
-    global drive_multimeter
-    global lock_in
-    
-    rm = visa.ResourceManager()
-    therm_multimeter = instruments.HPMultimeter("GPIB0::1::INSTR", rm, "therm_multimeter")
-    drive_multimeter = instruments.HPMultimeter("GPIB0::2::INSTR", rm, "drive_multimeter")
-    drive_FG = instruments.AgilentFunctionGenerator("GPIB0::3::INSTR", rm, "drive_FG")
-    source_meter = instruments.KeithelySourcemeter("GPIB0::4::INSTR", rm, "source_meter")
-
-    lock_in = instruments.SRLockin("GPIB0::5::INSTR", rm, "lock_in")
-    lock_in.set_time_constant(9) # set the time constant to 300ms (8 = 100ms etc)
-
-    drive_FG.set_shape("SIN", False)
-    drive_FG.set_amplitude(1, False) # voltages are peak to peak
-    drive_FG.set_offset(0, False)
-    drive_FG.set_frequency((2, "KHZ"), False)
-    drive_FG.apply_settings()
-
-    lock_in.auto_phase()
-    time.sleep(5)
-    lock_in.auto_gain()
-    time.sleep(5)
-
-    heater = instruments.Heater(source_meter, 90)
-    thermometer = instruments.Thermometer(therm_multimeter, "thermometer")
-
-def letsGetThisOverWith():
-    setupExperiment()
-    heater.power(1)
-    heater.on()
-    while True:
-        print thermometer.temperature()
-
-def finishExperiment():
-    # turn off the Keithley 2400 Sourcemeter for safety reasons
-    heater.off()
-    
-
-def collectDataPoint():
-    T = thermometer.temperature() # overall phase was 39.08
-    drive_FG.set_frequency((1, "KHZ",))
-    V_drive_1 = drive_multimeter.measure_voltage_AC()
-    lock_in.auto_gain()
-    time.sleep(10)
-    lock_in_vals_1 = lock_in.read()
-    T2 = thermometer.temperature()
-    drive_FG.set_frequency((2, "KHZ",))
-    V_drive_2 = drive_multimeter.measure_voltage_AC()
-    lock_in.auto_gain()
-    time.sleep(10)
-    lock_in_vals_2 = lock_in.read()
-    T3 = thermometer.temperature()
-    drive_FG.set_frequency((4, "KHZ",))
-    V_drive_4 = drive_multimeter.measure_voltage_AC()
-    lock_in.auto_gain()
-    time.sleep(10)
-    lock_in_vals_4 = lock_in.read()
-    T4 = thermometer.temperature()
-    drive_FG.set_frequency((8, "KHZ",))
-    V_drive_8 = drive_multimeter.measure_voltage_AC()
-    lock_in.auto_gain()
-    time.sleep(10)
-    lock_in_vals_8 = lock_in.read()
-    T5 = thermometer.temperature()
-    drive_FG.set_frequency((2, "KHZ",))
-    print "Recorded temperature range ", T, T2, T3, T4, T5
-    return {"Temperature1": T, "Temperature2": T2, "Temperature3": T3, "Temperature4": T4, "Temperature5": T5, \
-            "Drive Current RMS1": V_drive_1/drive_resistor, "R1": lock_in_vals_1[0], "Theta1": lock_in_vals_1[1], \
-            "Drive Current RMS2": V_drive_2/drive_resistor, "R2": lock_in_vals_2[0], "Theta2": lock_in_vals_2[1], \
-            "Drive Current RMS4": V_drive_4/drive_resistor, "R4": lock_in_vals_4[0], "Theta4": lock_in_vals_4[1], \
-            "Drive Current RMS8": V_drive_8/drive_resistor, "R8": lock_in_vals_8[0], "Theta8": lock_in_vals_8[1]}
+# the thermometer averages 5 samples at 1 power line cycle each (~0.08 s),
+# the estimator does the rest of the smoothing
+thermometer_samples = 5
+thermometer_nplc = 1
+
+# a setpoint is held until a 10 s window of readings drifts by less than
+# 5 mK/s, scatters by less than 20 mK and sits within 0.1 K of the setpoint
+temperature_settling = settling.SettlingDetector(30, 0.005, 0.02, 50, target_tolerance = 0.1)
+
+# the heater loop runs every ~0.33 s on the Kalman filtered temperature and
+# rate. The default gains are still the ones tuned by hand on the cryostat for
+# raw readings every ~0.67 s; the filtered loop takes much higher gains on the
+# simulated plant, but those should come from an autotune GainSchedule
+# (--gains) until they have been checked on the hardware
+temperature_poll_time = 0.25
+default_gains = (0.09, 0.002, 0.2)
+
+# after a gain change the lock-in is polled once per time constant until R
+# drifts by less than 1%/s and scatters by less than 0.5%, or 10 s pass
+lock_in_settling = settling.SettlingDetector(5, 0.01, 0.005, 10, relative = True)
+lock_in_min_settle = 5 # time constants to wait before polling
+
+max_heater_power = 0.4
+relay_amplitude = 0.05 # W either side of the hold power while autotuning
+
+# hold powers learned across runs, kept next to the run directories
+hold_power_file = "HOLDPOWER"
+
+# continuous ramps sample every 0.5 s and re-range the lock-in every minute
+ramp_sample_time = 0.5
+ramp_gain_interval = 60
+
+# buffered acquisition stores R and theta in the lock-in at 64 Hz for 10 s
+# per frequency once settled and fetches them in one binary transfer
+lock_in_buffer_rate = 64
+lock_in_buffer_time = 10
+
+# GPIB addresses of the instruments of one rig, as wired for setupExperiment
+default_addresses = {"therm_multimeter": "GPIB0::1::INSTR", "drive_multimeter": "GPIB0::2::INSTR", \
+                     "drive_FG": "GPIB0::3::INSTR", "source_meter": "GPIB0::4::INSTR", \
+                     "lock_in": "GPIB0::5::INSTR"}
+
+def boardAddresses(board):
+    """default_addresses on GPIB interface board instead of GPIB0"""
+    return dict((name, address.replace("GPIB0::", "GPIB{b}::".format(b = board))) \
+                for name, address in default_addresses.items())
 
 def dec_range(start, stop, step):
     r = start
@@ -107,14 +88,26 @@ def dec_range(start, stop, step):
         yield r
         r += step
 
-def record_temp_file(dir, index):
-    file_path = os.path.join(dir, "INCOMPLETEDATA_{i}".format(i=index))
-    pickle.dump(data, open(file_path, 'wb+'))
-
-def temperature():
-    setupExperiment()
-    while True:
-        print thermometer.temperature()
+def recover_run(base_directory):
+    """Returns the data recorded so far in a run directory together with the
+    controller states saved with each point (None where unavailable)"""
+    inter_directory = os.path.join(base_directory, "TEMP")
+    records = checkpoint.read_records(os.path.join(inter_directory, "CHECKPOINT"))
+    if records:
+        return [point for point, state in records], [state for point, state in records]
+
+    # runs taken before the checkpoint log only have INCOMPLETEDATA_* snapshots
+    recovered = runstore.read_snapshot(inter_directory)
+    return recovered, [None]*len(recovered)
+
+def plannedSetpoints(planner, data):
+    """Yields the setpoints chosen by a planner.AdaptivePlanner, telling it of
+    the point appended to data after each one"""
+    setpoint = planner.next_setpoint(time.time())
+    while setpoint is not None:
+        yield setpoint
+        planner.add(setpoint, data[-1], time.time())
+        setpoint = planner.next_setpoint(time.time())
 
 def clamp(p, c):
     if p > c:
@@ -123,137 +116,716 @@ def clamp(p, c):
         return 0
     return p
 
-def testHeater():
-    epsilon = 0.05
-    setupExperiment()
-    heater.power(0)
-    heater.on()
-    pid_controller = pid.PIDController(0.09*0.1, 0.002*0.1, 0.2*0.05)
-    pid_controller.soft_reset()
-    for target_temp in range(305, 310):
-        print "Adjusting temp to {t}".format(t=target_temp)
-        pid_controller.time_reset()
-        measured_temp = thermometer.temperature()
-        while measured_temp < target_temp:
-            measured_temp = thermometer.temperature()
-            pid_output = pid_controller.update(measured_temp, target_temp)
-            heater.power(clamp(pid_output,0.4))
-            print measured_temp, clamp(pid_output, 0.4)
-            time.sleep(0.5)
-
-
-        for i in range(60):
-            measured_temp = thermometer.temperature()
-            pid_output = pid_controller.update(measured_temp, target_temp)
-            heater.power(clamp(pid_output,0.4))
-            time.sleep(0.5)
-            print measured_temp
-
-        avg_iters = 40
-        phold = 0
-        for i in range(avg_iters):
-            measured_temp = thermometer.temperature()
-            pid_output = pid_controller.update(measured_temp, target_temp)
-            heater.power(clamp(pid_output,0.4))
-            phold += clamp(pid_output, 0.4)
-            time.sleep(0.5)
-            print measured_temp    
-        phold = phold/avg_iters;
+class Experiment(object):
+    """One sample rig with its own instruments, settling detectors and data.
+    addresses overrides entries of default_addresses, so several rigs on other
+    addresses or boards can be driven from one process (see runConcurrently).
+    Named rigs prefix their output with the name and keep their own hold power
+    map. With a tracing.Tracer every instrument transaction and phase of a run
+    is timed. Readings and messages go out through a telemetry.Publisher, by
+    default one that echoes them to the console from its own thread. A
+    buffered rig averages the lock-in data buffer at every frequency and
+    records the standard errors and sample counts with each point. The heater
+    loop acts on the temperature and rate estimated by its own
+    estimator.TemperatureEstimator."""
+    def __init__(self, name = None, addresses = None, data = None, tracer = None, publisher = None, \
+                 buffered = False):
+        self.name = name
+        self.buffered = buffered
+        self.lock_in_buffers = {}
+        self.tracer = tracer
+        self.publisher = publisher if publisher is not None else telemetry.Publisher()
+        self.addresses = dict(default_addresses)
+        self.addresses.update(addresses or {})
+        self.data = data if data is not None else []
+        self.rm = None
+        self.heater = None
+        self.drive_FG = None
+        self.thermometer = None
+        self.source_meter = None
+        self.therm_multimeter = None
+        self.drive_multimeter = None
+        self.lock_in = None
+        self.instrument_scheduler = None
+        self.on_setup = None
+        self.drive_resistor = drive_resistor
+        self.max_heater_power = max_heater_power
+        self.hold_power_file = hold_power_file if name is None else "{f}_{n}".format(f = hold_power_file, n = name)
+        # the detectors keep the readings of the current wait
+        self.temperature_settling = copy.deepcopy(temperature_settling)
+        self.lock_in_settling = copy.deepcopy(lock_in_settling)
+        self.estimator = estimator.TemperatureEstimator()
+
+    def log(self, *values):
+        self.publisher.publish("message", rig = self.name, text = " ".join(str(value) for value in values))
+
+    def publishControl(self, temperature, setpoint = None, pid_controller = None, power = None, \
+                       filtered = None, rate = None):
+        """Publishes a control loop sample with the PID terms of pid_controller
+        and the estimated temperature and rate"""
+        terms = list(pid_controller.terms) if pid_controller is not None else None
+        self.publisher.publish("control", rig = self.name, temperature = temperature, setpoint = setpoint, \
+                               pid = terms, power = power, filtered = filtered, rate = rate)
+
+    def controlStep(self, pid_controller, setpoint):
+        """One pass of the heater loop: reads the thermometer, filters the reading
+        and sets the heater power from the filtered temperature and rate. Returns
+        the raw reading and the power set."""
+        measured_temp = self.instrument_scheduler.run(self.thermometer, self.thermometer.temperature)
+        noise = self.thermometer.noise/thermometer_samples**0.5 if self.thermometer.noise else None
+        filtered, rate = self.estimator.update(measured_temp, time.time(), noise)
+        power = clamp(pid_controller.update(filtered, setpoint, rate), self.max_heater_power)
+        self.heaterCall(self.heater.power, power)
+        self.estimator.set_power(power)
+        self.publishControl(measured_temp, setpoint, pid_controller, power, filtered, rate)
+        return measured_temp, power
+
+    def span(self, name, lane = "run", **args):
+        """Times the phase of a run it wraps when tracing"""
+        if self.tracer is None:
+            return tracing.no_span
+        if self.name is not None:
+            lane = "{n} {l}".format(n = self.name, l = lane)
+        return self.tracer.span(name, lane = lane, **args)
+
+    def setupThermometer(self, resource_manager = None, warm = False):
+        """Connects to and configures only the thermometer multimeter, through
+        resource_manager if given or VISA otherwise"""
+        self.rm = resource_manager if resource_manager is not None else instruments.resource_manager()
+        if self.tracer is not None:
+            self.rm = tracing.TracedResourceManager(self.rm, self.tracer, self.name)
+        self.therm_multimeter = instruments.HPMultimeter(self.addresses["therm_multimeter"], self.rm, \
+                                                         "therm_multimeter", warm)
+        self.therm_multimeter.configure("VOLT:DC", thermometer_samples, thermometer_nplc)
+        self.thermometer = instruments.Thermometer(self.therm_multimeter, "thermometer")
+        self.instrument_scheduler = scheduler.InstrumentScheduler()
+
+    def setupHeater(self, warm = False):
+        """Connects to the sourcemeter driving the heater, after setupThermometer"""
+        self.source_meter = instruments.KeithelySourcemeter(self.addresses["source_meter"], self.rm, "source_meter", warm)
+        self.heater = instruments.Heater(self.source_meter, 90)
+
+    def setupExperiment(self, resource_manager = None, warm = False):
+        """Connects to and configures every instrument, through resource_manager
+        if given (e.g. a simulation.SimulatedResourceManager) or VISA otherwise.
+        A warm start takes the instruments as they are: it checks their
+        identities and reads their settings back instead of resetting them,
+        leaves the heater running and keeps the lock-in phase and gain."""
+        self.setupThermometer(resource_manager, warm)
+        self.drive_multimeter = instruments.HPMultimeter(self.addresses["drive_multimeter"], self.rm, \
+                                                         "drive_multimeter", warm)
+        self.drive_FG = instruments.AgilentFunctionGenerator(self.addresses["drive_FG"], self.rm, "drive_FG", warm)
+        self.setupHeater(warm)
+        self.drive_multimeter.configure("VOLT:AC")
+
+        self.lock_in = instruments.SRLockin(self.addresses["lock_in"], self.rm, "lock_in", warm)
+        self.lock_in.set_time_constant(9) # set the time constant to 300ms (8 = 100ms etc)
+        if self.buffered:
+            self.lock_in.set_filter_slope(3) # 24 dB/oct, for the shortest correlation time per settling time
+            self.lock_in.configure_buffer(lock_in_buffer_rate)
+
+        self.drive_FG.set_shape("SIN", False)
+        self.drive_FG.set_amplitude(1, False) # voltages are peak to peak
+        self.drive_FG.set_offset(0, False)
+        self.drive_FG.set_frequency((2, "KHZ"), False)
+        self.drive_FG.apply_settings()
+
+        if not warm:
+            self.lock_in.auto_phase()
+            self.lock_in.wait_until_idle()
+            self.lock_in.auto_gain()
+            self.lock_in.wait_until_idle()
+
+        if self.on_setup is not None:
+            self.on_setup(self)
+
+    def letsGetThisOverWith(self):
+        self.setupThermometer(warm = True)
+        self.setupHeater(warm = True)
+        self.heater.power(1)
+        self.heater.on()
+        while True:
+            self.publishControl(self.thermometer.temperature(), power = 1)
+
+    def heaterCall(self, fn, *args):
+        """Calls a heater method holding the sourcemeter, so that the heater can be
+        turned off from another thread without interleaving with this rig"""
+        return self.instrument_scheduler.run(self.source_meter, fn, *args)
+
+    def finishExperiment(self):
+        # turn off the Keithley 2400 Sourcemeter for safety reasons
+        self.heaterCall(self.heater.off)
+        self.publisher.flush()
+
+    def measureAtFrequency(self, frequency):
+        """Switches the drive to frequency (in kHz) and reads the lock-in once it has
+        settled, reading the thermometer and drive current during the wait"""
+        with self.span("measure {f} kHz".format(f = frequency)):
+            self.instrument_scheduler.run(self.drive_FG, self.drive_FG.set_frequency, (frequency, "KHZ",))
+            T = self.instrument_scheduler.submit(self.thermometer, self.thermometer.temperature)
+            V_drive = self.instrument_scheduler.submit(self.drive_multimeter, self.drive_multimeter.measure_voltage_AC)
+            self.instrument_scheduler.run(self.lock_in, self.lock_in.auto_gain)
+            lock_in_vals = self.readSettledLockIn()
+            if self.buffered:
+                reading = self.readLockInBuffer()
+                self.lock_in_buffers[frequency] = reading
+                lock_in_vals = list(reading.mean)
+            self.publisher.publish("lock-in", rig = self.name, frequency = frequency, \
+                                   R = lock_in_vals[0], theta = lock_in_vals[1])
+            return T.result(), V_drive.result(), lock_in_vals
+
+    def readLockInBuffer(self):
+        """Fills the lock-in data buffer for lock_in_buffer_time seconds and
+        returns it as an instruments.BufferedReading"""
+        with self.span("lock-in buffer"):
+            self.instrument_scheduler.run(self.lock_in, self.lock_in.start_buffer)
+            time.sleep(lock_in_buffer_time)
+            return self.instrument_scheduler.run(self.lock_in, self.lock_in.fetch_buffer)
+
+    def readSettledLockIn(self):
+        """Polls the lock-in until its magnitude has stopped changing and returns the last reading.
+        Waits first for an auto gain still in progress, whose readings are at the old sensitivity"""
+        with self.span("lock-in settle"):
+            tau = self.lock_in.time_constant
+            self.instrument_scheduler.run(self.lock_in, self.lock_in.wait_until_idle)
+            self.lock_in_settling.reset()
+            time.sleep(lock_in_min_settle*tau)
+            while True:
+                lock_in_vals = self.instrument_scheduler.run(self.lock_in, self.lock_in.read)
+                self.lock_in_settling.add(lock_in_vals[0])
+                if self.lock_in_settling.done():
+                    return lock_in_vals
+                time.sleep(tau)
+
+    def rerangeLockIn(self, hold):
+        """Auto gains the lock-in and waits for it to settle, calling hold every
+        temperature_poll_time in the background so the heater stays regulated"""
+        hold_loop = scheduler.HoldLoop(hold, temperature_poll_time)
+        hold_loop.start()
+        try:
+            self.instrument_scheduler.run(self.lock_in, self.lock_in.auto_gain)
+            self.readSettledLockIn()
+        finally:
+            hold_loop.stop()
+
+    def collectDataPoint(self, hold = None):
+        """Measures at 1, 2, 4 and 8 kHz. If hold is given it is called every
+        temperature_poll_time in the background to keep the heater regulated
+        during the measurement"""
+        if hold is not None:
+            hold_loop = scheduler.HoldLoop(hold, temperature_poll_time)
+            hold_loop.start()
+        self.lock_in_buffers.clear()
+        try:
+            with self.span("acquire"):
+                T, V_drive_1, lock_in_vals_1 = self.measureAtFrequency(1) # overall phase was 39.08
+                T2, V_drive_2, lock_in_vals_2 = self.measureAtFrequency(2)
+                T3, V_drive_4, lock_in_vals_4 = self.measureAtFrequency(4)
+                T4, V_drive_8, lock_in_vals_8 = self.measureAtFrequency(8)
+                T5 = self.instrument_scheduler.submit(self.thermometer, self.thermometer.temperature)
+                self.instrument_scheduler.run(self.drive_FG, self.drive_FG.set_frequency, (2, "KHZ",))
+                T5 = T5.result()
+        finally:
+            if hold is not None:
+                hold_loop.stop()
+        self.log("Recorded temperature range ", T, T2, T3, T4, T5)
+        point = {"Temperature1": T, "Temperature2": T2, "Temperature3": T3, "Temperature4": T4, "Temperature5": T5, \
+                 "Drive Current RMS1": V_drive_1/self.drive_resistor, "R1": lock_in_vals_1[0], "Theta1": lock_in_vals_1[1], \
+                 "Drive Current RMS2": V_drive_2/self.drive_resistor, "R2": lock_in_vals_2[0], "Theta2": lock_in_vals_2[1], \
+                 "Drive Current RMS4": V_drive_4/self.drive_resistor, "R4": lock_in_vals_4[0], "Theta4": lock_in_vals_4[1], \
+                 "Drive Current RMS8": V_drive_8/self.drive_resistor, "R8": lock_in_vals_8[0], "Theta8": lock_in_vals_8[1]}
+        for frequency, reading in self.lock_in_buffers.items():
+            point["R{f} Error".format(f = frequency)] = reading.stderr[0]
+            point["Theta{f} Error".format(f = frequency)] = reading.stderr[1]
+            point["Samples{f}".format(f = frequency)] = reading.count
+        return point
+
+    def writeStatistics(self):
+        """Instrument writes sent and skipped as redundant, by instrument name"""
+        return dict((instrument.name, instrument.shadow.statistics()) for instrument in \
+                    (self.therm_multimeter, self.drive_multimeter, self.drive_FG, self.source_meter, self.lock_in))
+
+    def instrumentSettings(self):
+        """Instrument configuration recorded with a run in the catalog"""
+        return {"thermometer_samples": thermometer_samples, "thermometer_nplc": thermometer_nplc, \
+                "drive_shape": self.drive_FG.shape, "drive_amplitude": self.drive_FG.amplitude, \
+                "drive_offset": self.drive_FG.offset, "drive_resistor": self.drive_resistor, \
+                "lock_in_time_constant": self.lock_in.time_constant, \
+                "lock_in_filter_slope": 6*(self.lock_in.get_filter_slope() + 1), \
+                "max_heater_power": self.max_heater_power, \
+                "lock_in_buffer_rate": lock_in_buffer_rate if self.buffered else None, \
+                "lock_in_buffer_time": lock_in_buffer_time if self.buffered else None}
+
+    def temperature(self):
+        self.setupThermometer(warm = True)
+        while True:
+            self.publishControl(self.thermometer.temperature())
+
+    def testHeater(self, resource_manager = None, gain_schedule = None):
+        """Steps the heater loop of runExperiment, with its gains or those of
+        gain_schedule, through 305-309 K: regulates for 30 s at each, averages
+        the power over 20 s more and then holds that power for 10 s"""
+        self.setupExperiment(resource_manager)
+        self.heaterCall(self.heater.power, 0)
+        self.heaterCall(self.heater.on)
+        pid_controller = pid.PIDController(*default_gains)
+        pid_controller.soft_reset()
+        pid_controller.limits = (0, self.max_heater_power)
+        self.estimator.reset()
+        for target_temp in range(305, 310):
+            self.log("Adjusting temp to {t}".format(t=target_temp))
+            if gain_schedule is not None:
+                pid_controller.set_gains(*gain_schedule.gains(target_temp))
+            pid_controller.time_reset()
+            measured_temp = self.thermometer.temperature()
+            while measured_temp < target_temp:
+                measured_temp, power = self.controlStep(pid_controller, target_temp)
+                time.sleep(temperature_poll_time)
+
+            for i in range(int(30/temperature_poll_time)):
+                self.controlStep(pid_controller, target_temp)
+                time.sleep(temperature_poll_time)
+
+            avg_iters = int(20/temperature_poll_time)
+            phold = 0
+            for i in range(avg_iters):
+                measured_temp, power = self.controlStep(pid_controller, target_temp)
+                phold += power
+                time.sleep(temperature_poll_time)
+            phold = phold/avg_iters;
         
-        heater.power(phold)
-        for i in range(10):
-            print thermometer.temperature()
-            time.sleep(1)
+            self.heaterCall(self.heater.power, phold)
+            self.estimator.set_power(phold)
+            for i in range(10):
+                self.publishControl(self.thermometer.temperature(), target_temp, power = phold)
+                time.sleep(1)
             
-    heater.off()
+        self.heaterCall(self.heater.off)
 
-def runExperiment(start_temp, end_temp, temp_res, base_directory):
+    def approachSetpoint(self, pid_controller, target_temp):
+        """Heats up to target_temp and regulates there until the temperature has
+        settled, returning the hold power (the average output over the settled window)"""
+        pid_controller.time_reset()
+        with self.span("ramp", setpoint = target_temp):
+            measured_temp = self.thermometer.temperature()
+            while measured_temp < target_temp:
+                measured_temp, power = self.controlStep(pid_controller, target_temp)
+                time.sleep(temperature_poll_time)
+
+        self.temperature_settling.reset()
+        outputs = []
+        with self.span("settle", setpoint = target_temp):
+            while not self.temperature_settling.done(target_temp):
+                measured_temp, power = self.controlStep(pid_controller, target_temp)
+                self.temperature_settling.add(measured_temp)
+                outputs.append(power)
+                time.sleep(temperature_poll_time)
+        outputs = outputs[-self.temperature_settling.window:]
+        return sum(outputs)/len(outputs)
+
+    def autotuneExperiment(self, temperatures, schedule_path, resource_manager = None, rule = "tyreus-luyben"):
+        """Identifies the heater loop by relay feedback at each of temperatures (in
+        increasing order) and saves the resulting gain schedule to schedule_path"""
+        self.setupExperiment(resource_manager)
+        self.heater.power(0)
+        self.heater.on()
+        pid_controller = pid.PIDController(*default_gains)
+        pid_controller.soft_reset()
+        pid_controller.limits = (0, self.max_heater_power)
+        self.estimator.reset()
+        schedule = autotune.GainSchedule()
+        for target_temp in temperatures:
+            self.log("Tuning at {t}".format(t=target_temp))
+            bias = self.approachSetpoint(pid_controller, target_temp)
+            amplitude = min(relay_amplitude, bias, self.max_heater_power - bias)
+            Ku, Pu = autotune.relay_autotune(self.thermometer.temperature, self.heater.power, target_temp, bias, amplitude)
+            gains = autotune.gains_from_ultimate(Ku, Pu, rule)
+            self.log("Ku = {k} W/K, Pu = {p} s, gains {g}".format(k=Ku, p=Pu, g=gains))
+            schedule.add(target_temp, gains)
+            schedule.save(schedule_path)
+            pid_controller.set_gains(*gains)
+        self.finishExperiment()
+        return schedule
+
+    def runExperiment(self, start_temp, end_temp, temp_res, base_directory, resume = False, \
+                      resource_manager = None, gain_schedule = None, hold_power_path = None, planner = None, \
+                      warm = False):
+        """Steps through the setpoints from start_temp to end_temp, measuring at each.
+        gain_schedule, an autotune.GainSchedule, sets the PID gains per setpoint.
+        Each setpoint starts from the hold power learned in earlier runs, stored in
+        hold_power_path (by default HOLDPOWER next to base_directory). A
+        planner.AdaptivePlanner, if given, chooses the setpoints instead of the
+        uniform temp_res grid. warm starts the instruments as they are (see
+        setupExperiment), e.g. to resume a run straight away."""
     
-    setupExperiment()
-
-    start_time = datetime.now()
-
-    inter_directory = os.path.join(base_directory, "TEMP")
-    if not os.path.exists(base_directory):
-        os.makedirs(base_directory)
-
-    if not os.path.exists(inter_directory):
-        os.makedirs(inter_directory)
-
-    index = 1
-    heater.power(0)
-    heater.on()
-    beta = 1
-    pid_controller = pid.PIDController(0.09*beta, 0.002*beta, 0.2*beta)
-    pid_controller.soft_reset()
-
-    measured_temp = thermometer.temperature()
-
-    print "Preheating..."
-    while abs(measured_temp - start_temp) > 1.5:
-        measured_temp = thermometer.temperature()
-        print measured_temp
-        pid_output = pid_controller.update(measured_temp, start_temp)
-        heater.power(clamp(pid_output, 0.4))
-        time.sleep(0.5)
+        self.setupExperiment(resource_manager, warm)
+
+        start_time = datetime.now()
+
+        inter_directory = os.path.join(base_directory, "TEMP")
+        if not os.path.exists(base_directory):
+            os.makedirs(base_directory)
+
+        if not os.path.exists(inter_directory):
+            os.makedirs(inter_directory)
+
+        if hold_power_path is None:
+            hold_power_path = os.path.join(os.path.dirname(os.path.abspath(base_directory)), self.hold_power_file)
+        hold_power_map = holdpower.HoldPowerMap(hold_power_path)
+
+        setpoints = list(dec_range(start_temp, end_temp, temp_res))
+        state = None
+        states = []
+        del self.data[:]
+        if resume:
+            recovered, states = recover_run(base_directory)
+            self.data.extend(recovered)
+            state = states[-1] if states else None
+            self.log("Resuming after {n} recorded setpoints".format(n=len(self.data)))
+
+        checkpoint_path = os.path.join(inter_directory, "CHECKPOINT")
+        resume_log = resume and len(checkpoint.read_records(checkpoint_path)) == len(self.data)
+        checkpoint_log = checkpoint.CheckpointWriter(checkpoint_path, truncate = not resume_log)
+        if not resume_log:
+            for point in self.data:
+                checkpoint_log.append(point)
+
+        index = len(self.data) + 1
+        if planner is not None:
+            for point, saved in zip(self.data, states):
+                # points from before the checkpoint log only have their temperatures
+                setpoint = saved["setpoint"] if saved and "setpoint" in saved else runstore.first_temperature(point)
+                planner.add(setpoint, runstore.normalize_record(point))
+            remaining = plannedSetpoints(planner, self.data)
+            first = planner.next_setpoint(time.time())
+        else:
+            remaining = setpoints[len(self.data):]
+            first = remaining[0] if remaining else None
+        preheat_temp = None
+        if first is not None:
+            preheat_temp = first if self.data else start_temp
+        if state is not None and "integral_output" not in state and "integral" not in state:
+            state = None
+
+        self.heaterCall(self.heater.power, 0)
+        self.heaterCall(self.heater.on)
+        pid_controller = pid.PIDController(*default_gains)
+        pid_controller.soft_reset()
+        pid_controller.limits = (0, self.max_heater_power)
+        self.estimator.reset()
+        self.estimator.hold_power = hold_power_map.predict
+        settings = self.instrumentSettings()
+        settings.update({"gains": [pid_controller.KP, pid_controller.KI, pid_controller.KD], \
+                         "gain_schedule": gain_schedule.entries if gain_schedule is not None else None, \
+                         "planner": planner.settings() if planner is not None else None})
+        run_entry = catalog.RunEntry(base_directory, "step", (start_temp, end_temp), \
+                                     temp_res if planner is None else None, settings, resume = resume)
+        for point in self.data:
+            run_entry.add_point(point)
+        run_entry.save()
+        if gain_schedule is not None and preheat_temp is not None:
+            pid_controller.set_gains(*gain_schedule.gains(preheat_temp))
+        # the restored integral stands in for the feed-forward of the first setpoint
+        restored = state is not None
+        if restored:
+            if "integral_output" in state:
+                # saved as KI x integral, since the gains may differ from those it built up under
+                pid_controller.soft_reset()
+                pid_controller.preload(state["integral_output"])
+            else:
+                # checkpoints written before the integral output was saved
+                pid_controller.restore(state["integral"])
+            self.heaterCall(self.heater.power, state["hold_power"])
+
+        measured_temp = self.thermometer.temperature()
+
+        self.log("Preheating...")
+        with self.span("preheat"):
+            while preheat_temp is not None and abs(measured_temp - preheat_temp) > 1.5:
+                measured_temp, power = self.controlStep(pid_controller, preheat_temp)
+                time.sleep(temperature_poll_time)
         
-    print "Finished preheating..."
+        self.log("Finished preheating...")
     
-    pid_controller.soft_reset()
+        if state is None:
+            pid_controller.soft_reset()
         
-    for target_temp in dec_range(start_temp, end_temp, temp_res):
-        print "Adjusting temp to {t}".format(t=target_temp)
-        pid_controller.time_reset()
-        measured_temp = thermometer.temperature()
-        while measured_temp < target_temp:
-            measured_temp = thermometer.temperature()
-            print measured_temp
-            pid_output = pid_controller.update(measured_temp, target_temp)
-            heater.power(clamp(pid_output,0.4))
-            time.sleep(0.5)
-
-
-        for i in range(60):
-            measured_temp = thermometer.temperature()
-            print measured_temp
-            pid_output = pid_controller.update(measured_temp, target_temp)
-            heater.power(clamp(pid_output,0.4))
-            time.sleep(0.5)
-
-        avg_iters = 40
-        phold = 0
-        for i in range(avg_iters):
-            measured_temp = thermometer.temperature()
-            print measured_temp
-            pid_output = pid_controller.update(measured_temp, target_temp)
-            heater.power(clamp(pid_output,0.4))
-            phold += clamp(pid_output, 0.4)
-            time.sleep(0.5)  
-        phold = phold/avg_iters;
-        print "Holding temperature for measurement."
-        heater.power(phold)
-        data.append(collectDataPoint())
-        record_temp_file(inter_directory, index)
-        print "Measurement taken."
-        index += 1
+        for target_temp in remaining:
+            self.log("Adjusting temp to {t}".format(t=target_temp))
+            if gain_schedule is not None:
+                pid_controller.set_gains(*gain_schedule.gains(target_temp))
+            feed_forward = hold_power_map.predict(target_temp)
+            if feed_forward is not None and not restored:
+                pid_controller.preload(clamp(feed_forward, self.max_heater_power))
+            restored = False
+            phold = self.approachSetpoint(pid_controller, target_temp)
+            hold_power_map.update(target_temp, phold)
+            hold_power_map.save()
+            self.log("Holding temperature for measurement.")
+            self.heaterCall(self.heater.power, phold)
+            self.estimator.set_power(phold)
+
+            def hold():
+                with self.span("hold", "hold"):
+                    self.controlStep(pid_controller, target_temp)
+
+            point = self.collectDataPoint(hold)
+            self.data.append(point)
+            checkpoint_log.append(point, {"index": index, "setpoint": target_temp, \
+                                          "integral_output": pid_controller.KI*pid_controller.integral, \
+                                          "hold_power": phold})
+            run_entry.add_point(point)
+            self.log("Measurement taken.")
+            index += 1
     
-    # record all of the data once finished
-    file_path = os.path.join(base_directory, "FINALDATA")
-    pickle.dump(data, open(file_path, 'wb+'))
-
-    end_time = datetime.now()
-    diff_time = end_time - start_time
-    print "Experimental duration: " + str(diff_time)
-    print data
-
-    finishExperiment()
+        checkpoint_log.close()
+
+        # record all of the data once finished
+        file_path = os.path.join(base_directory, "FINALDATA")
+        pickle.dump(self.data, open(file_path, 'wb+'))
+        runstore.write_run(os.path.join(base_directory, runstore.columns_directory), self.data)
+        run_entry.finish()
+
+        end_time = datetime.now()
+        diff_time = end_time - start_time
+        self.log("Experimental duration: " + str(diff_time))
+        for name, statistics in sorted(self.writeStatistics().items()):
+            self.log("{n}: {w} writes, {s} skipped".format(n = name, w = statistics["writes"], s = statistics["skipped"]))
+        self.log(self.data)
+
+        self.finishExperiment()
+
+    def runRampExperiment(self, start_temp, end_temp, rate, base_directory, frequency = 2, bin_width = None, \
+                          resource_manager = None, gain_schedule = None, hold_power_path = None, warm = False):
+        """Ramps the setpoint continuously from start_temp to end_temp at rate K/min
+        while streaming timestamped lock-in R/theta, drive current, temperature and
+        heater power samples at a single drive frequency (kHz). The samples go to
+        TEMP/CHECKPOINT as they are taken and to FINALDATA at the end, and with
+        bin_width the temperature-binned averages go to BINNEDDATA."""
+        self.setupExperiment(resource_manager, warm)
+
+        start_time = datetime.now()
+
+        inter_directory = os.path.join(base_directory, "TEMP")
+        if not os.path.exists(inter_directory):
+            os.makedirs(inter_directory)
+        if hold_power_path is None:
+            hold_power_path = os.path.join(os.path.dirname(os.path.abspath(base_directory)), self.hold_power_file)
+        hold_power_map = holdpower.HoldPowerMap(hold_power_path)
+        checkpoint_log = checkpoint.CheckpointWriter(os.path.join(inter_directory, "CHECKPOINT"))
+        del self.data[:]
+
+        self.heaterCall(self.heater.power, 0)
+        self.heaterCall(self.heater.on)
+        pid_controller = pid.PIDController(*default_gains)
+        pid_controller.soft_reset()
+        pid_controller.limits = (0, self.max_heater_power)
+        self.estimator.reset()
+        self.estimator.hold_power = hold_power_map.predict
+        settings = self.instrumentSettings()
+        settings.update({"gains": [pid_controller.KP, pid_controller.KI, pid_controller.KD], \
+                         "gain_schedule": gain_schedule.entries if gain_schedule is not None else None, \
+                         "rate": rate, "bin_width": bin_width})
+        run_entry = catalog.RunEntry(base_directory, "ramp", (start_temp, end_temp), None, settings, [frequency])
+        run_entry.save()
+        if gain_schedule is not None:
+            pid_controller.set_gains(*gain_schedule.gains(start_temp))
+        feed_forward = hold_power_map.predict(start_temp)
+        if feed_forward is not None:
+            pid_controller.preload(clamp(feed_forward, self.max_heater_power))
+        self.log("Preheating...")
+        with self.span("preheat"):
+            self.approachSetpoint(pid_controller, start_temp)
+        self.log("Finished preheating...")
+
+        self.drive_FG.set_frequency((frequency, "KHZ",))
+        self.rerangeLockIn(lambda: self.controlStep(pid_controller, start_temp))
+        drive = self.instrument_scheduler.submit(self.drive_multimeter, self.drive_multimeter.measure_voltage_AC)
+        drive_current = drive.result()/self.drive_resistor
+
+        ramp_start = time.time()
+        last_gain_change = ramp_start
+
+        def track():
+            # the setpoint keeps ramping while the lock-in is re-ranged
+            self.controlStep(pid_controller, ramp.ramp_setpoint(start_temp, end_temp, rate, time.time() - ramp_start))
+
+        setpoint = start_temp
+        while setpoint < end_temp:
+            now = time.time()
+            setpoint = ramp.ramp_setpoint(start_temp, end_temp, rate, now - ramp_start)
+            if gain_schedule is not None:
+                pid_controller.set_gains(*gain_schedule.gains(setpoint))
+            if now - last_gain_change > ramp_gain_interval:
+                self.rerangeLockIn(track)
+                last_gain_change = time.time()
+
+            # the drive current changes slowly, so it is refreshed in the background
+            if drive.done():
+                drive_current = drive.result()/self.drive_resistor
+                drive = self.instrument_scheduler.submit(self.drive_multimeter, self.drive_multimeter.measure_voltage_AC)
+            measured_temp, pid_output = self.controlStep(pid_controller, setpoint)
+            lock_in_vals = self.instrument_scheduler.run(self.lock_in, self.lock_in.read)
+
+            sample = {"Time": now, "Setpoint": setpoint, "Temperature": measured_temp, \
+                      "R": lock_in_vals[0], "Theta": lock_in_vals[1], \
+                      "Drive Current RMS": drive_current, "Heater Power": pid_output}
+            self.data.append(sample)
+            checkpoint_log.append(sample)
+            run_entry.add_point(sample)
+            self.publisher.publish("lock-in", rig = self.name, frequency = frequency, \
+                                   R = lock_in_vals[0], theta = lock_in_vals[1])
+            time.sleep(ramp_sample_time)
+
+        drive.result()
+        checkpoint_log.close()
+        pickle.dump(self.data, open(os.path.join(base_directory, "FINALDATA"), 'wb+'))
+        runstore.write_run(os.path.join(base_directory, runstore.columns_directory), self.data)
+        if bin_width is not None:
+            binned = ramp.bin_by_temperature(self.data, bin_width)
+            pickle.dump(binned, open(os.path.join(base_directory, "BINNEDDATA"), 'wb+'))
+        run_entry.finish()
+
+        self.log("Experimental duration: " + str(datetime.now() - start_time))
+        self.log("{n} samples recorded".format(n = len(self.data)))
+        self.finishExperiment()
+
+def publishInstruments(experiment):
+    """Mirrors the instruments of the default rig in the module globals"""
+    global rm
+    global source_meter
+    global heater
+    global drive_FG
+    global therm_multimeter
+    global thermometer
+    global drive_multimeter
+    global lock_in
+    global instrument_scheduler
+
+    rm = experiment.rm
+    source_meter = experiment.source_meter
+    heater = experiment.heater
+    drive_FG = experiment.drive_FG
+    therm_multimeter = experiment.therm_multimeter
+    thermometer = experiment.thermometer
+    drive_multimeter = experiment.drive_multimeter
+    lock_in = experiment.lock_in
+    instrument_scheduler = experiment.instrument_scheduler
+
+# the module level functions drive this rig, on the default addresses
+default_rig = Experiment(data = data)
+default_rig.on_setup = publishInstruments
+
+setupExperiment = default_rig.setupExperiment
+letsGetThisOverWith = default_rig.letsGetThisOverWith
+finishExperiment = default_rig.finishExperiment
+measureAtFrequency = default_rig.measureAtFrequency
+readSettledLockIn = default_rig.readSettledLockIn
+collectDataPoint = default_rig.collectDataPoint
+writeStatistics = default_rig.writeStatistics
+instrumentSettings = default_rig.instrumentSettings
+temperature = default_rig.temperature
+testHeater = default_rig.testHeater
+approachSetpoint = default_rig.approachSetpoint
+autotuneExperiment = default_rig.autotuneExperiment
+runExperiment = default_rig.runExperiment
+runRampExperiment = default_rig.runRampExperiment
+
+def runConcurrently(jobs):
+    """Runs every (function, args) of jobs on its own thread, typically the run
+    methods of different rigs, and returns their results once all have finished.
+    A rig that fails has its heater turned off at once, on its own thread, while
+    the others carry on, and the first error is raised at the end. On
+    KeyboardInterrupt every heater is turned off."""
+    tasks = [scheduler.Task(threading.Lock(), runFailSafe, (function, args)) for function, args in jobs]
+    try:
+        for task in tasks:
+            # a join without a timeout would not see KeyboardInterrupt
+            while not task.done():
+                task.thread.join(1)
+    except KeyboardInterrupt:
+        for function, args in jobs:
+            heaterOff(function, "Interrupted")
+        raise
+    return [task.result() for task in tasks]
+
+def runFailSafe(function, args):
+    """Calls function(*args), turning the heater of its rig off if it fails"""
+    try:
+        return function(*args)
+    except Exception:
+        heaterOff(function, "Failed")
+        raise
+
+def heaterOff(function, reason):
+    """Turns off the heater of the rig whose method function is, if any"""
+    rig = getattr(function, "__self__", None)
+    if isinstance(rig, Experiment) and rig.heater is not None:
+        rig.log(reason + ", turning the heater off")
+        rig.heaterCall(rig.heater.off)
 
 if __name__ == "__main__":
     arguments = sys.argv[1:]
+    if arguments[0] == "autotune":
+        # experiment.py autotune T1 T2 ... SCHEDULE_FILE
+        temperatures = [float(a) for a in arguments[1:-1]]
+        autotuneExperiment(temperatures, os.path.join(os.getcwd(), arguments[-1]))
+        sys.exit()
+
+    if arguments[0] == "ramp":
+        # experiment.py ramp START END RATE_K_PER_MIN DIR [--frequency KHZ] [--bin WIDTH] [--trace]
+        #               [--telemetry PORT] [--warm]
+        options = arguments[5:]
+        frequency = 2
+        bin_width = None
+        if "--frequency" in options:
+            frequency = float(options[options.index("--frequency") + 1])
+        if "--bin" in options:
+            bin_width = float(options[options.index("--bin") + 1])
+        if "--trace" in options:
+            default_rig.tracer = tracing.Tracer()
+        directory = os.path.join(os.getcwd(), arguments[4])
+        default_rig.publisher.path = os.path.join(directory, "TELEMETRY")
+        if "--telemetry" in options:
+            default_rig.publisher.port = int(options[options.index("--telemetry") + 1])
+        runRampExperiment(float(arguments[1]), float(arguments[2]), float(arguments[3]), \
+                          directory, frequency, bin_width, warm = "--warm" in options)
+        if default_rig.tracer is not None:
+            tracing.export(default_rig.tracer, directory)
+        sys.exit()
+
     start_temp = float(arguments[0])
     end_temp = float(arguments[1])
     resolution = float(arguments[2])
     directory = os.path.join(os.getcwd(), arguments[3])
-
-    runExperiment(start_temp, end_temp, resolution, directory)
+    options = arguments[4:]
+    resume = "--resume" in options
+    # --warm skips the instrument resets and the auto phase and gain
+    warm = "--warm" in options
+    gain_schedule = None
+    if "--gains" in options:
+        gain_schedule = autotune.GainSchedule.load(options[options.index("--gains") + 1])
+    default_rig.buffered = "--buffered" in options
+    planner = None
+    if "--adaptive" in options:
+        # --adaptive MAX_STEP [--budget HOURS] lets the steps grow from RES up
+        # to MAX_STEP away from the transition
+        time_budget = None
+        if "--budget" in options:
+            time_budget = 3600*float(options[options.index("--budget") + 1])
+        planner = setpoint_planner.AdaptivePlanner(start_temp, end_temp, resolution, \
+            float(options[options.index("--adaptive") + 1]), time_budget = time_budget)
+    if "--trace" in options:
+        # TRACE.json and LATENCY are written next to the data
+        default_rig.tracer = tracing.Tracer()
+    # the samples of the run are kept in TELEMETRY and, with --telemetry PORT,
+    # sent to telemetry.py PORT
+    default_rig.publisher.path = os.path.join(directory, "TELEMETRY")
+    if "--telemetry" in options:
+        default_rig.publisher.port = int(options[options.index("--telemetry") + 1])
+
+    runExperiment(start_temp, end_temp, resolution, directory, resume, gain_schedule = gain_schedule, planner = planner, \
+                  warm = warm)
+    if default_rig.tracer is not None:
+        tracing.export(default_rig.tracer, directory)
     
@@ -0,0 +1,142 @@
+# FITTING.py
+# Batch fits of the critical behaviour near the Curie transition over many runs,
+# frequencies and temperature windows, as done by hand in the GdCl notebooks
+import sys
+import csv
+import multiprocessing
+
+import numpy
+from scipy.optimize import least_squares
+
+import runstore
+
+def curie(T, A, Tc, b, c):
+    """Power law divergence A (T - Tc)^-b above Tc on a constant background c"""
+    return A*(T - Tc)**(-b) + c
+
+def curie_no_background(T, A, Tc, b):
+    return A*(T - Tc)**(-b)
+
+def inverse(T, a, Tc, p):
+    """Inverse susceptibility a (T - Tc)^p, fitted to 1/signal"""
+    return a*(T - Tc)**p
+
+# function, parameter names, whether it is fitted to 1/signal
+models = {
+    "curie": (curie, ("A", "Tc", "b", "c"), False),
+    "curie-no-background": (curie_no_background, ("A", "Tc", "b"), False),
+    "inverse": (inverse, ("a", "Tc", "p"), True),
+}
+
+def load_curve(run_path, frequency = 2, signal = "R"):
+    """Temperatures and signal at one drive frequency (kHz) of a COLUMNS run
+    store, sorted by temperature with missing points dropped. Both are empty if
+    the run did not record that frequency."""
+    names = runstore.frequency_columns(run_path, frequency)
+    if names is None or signal not in names:
+        return numpy.empty(0), numpy.empty(0)
+    columns = runstore.open_run(run_path, [names["Temperature"], names[signal]])
+    T = numpy.array(columns[names["Temperature"]])
+    y = numpy.array(columns[names[signal]])
+    keep = numpy.isfinite(T) & numpy.isfinite(y)
+    order = numpy.argsort(T[keep])
+    return T[keep][order], y[keep][order]
+
+def initial_guess(model, T, y):
+    span = T[-1] - T[0]
+    Tc = T[0] - 0.05*span
+    if model == "inverse":
+        return [1.0/(y[-1]*(T[-1] - Tc)), Tc, 1.0]
+    A = (y[0] - y[-1])*(T[0] - Tc)
+    return [A, Tc, 1.0, y[-1]][:len(models[model][1])]
+
+def fit_window(T, y, t_min, t_max, model = "curie", p0 = None):
+    """Fits model to the points with t_min <= T <= t_max, which should lie above
+    Tc. Returns a dict with each parameter, its standard error ("<name> Error"),
+    the number of points and the reduced chi squared."""
+    function, names, inverted = models[model]
+    window = (T >= t_min) & (T <= t_max)
+    T, y = T[window], y[window]
+    row = {"Model": model, "Window Min": t_min, "Window Max": t_max, "Points": len(T)}
+    if len(T) <= len(names):
+        row["Status"] = "too few points"
+        return row
+    if inverted:
+        y = 1.0/y
+    if p0 is None:
+        p0 = initial_guess(model, T, y)
+    # Tc has to stay below the window for the power law to be defined
+    lower = [-numpy.inf]*len(names)
+    upper = [numpy.inf]*len(names)
+    upper[1] = T[0] - 1e-6*(T[-1] - T[0])
+    p0[1] = min(p0[1], upper[1] - 1e-6)
+    scale = numpy.abs(y).mean()
+
+    def residuals(p):
+        return (function(T, *p) - y)/scale
+
+    result = least_squares(residuals, p0, bounds = (lower, upper), x_scale = 'jac')
+    dof = len(T) - len(names)
+    chi2 = 2*result.cost/dof
+    try:
+        covariance = numpy.linalg.inv(numpy.dot(result.jac.T, result.jac))*chi2
+        errors = numpy.sqrt(numpy.abs(numpy.diag(covariance)))
+    except numpy.linalg.LinAlgError:
+        errors = [numpy.nan]*len(names)
+    for name, value, error in zip(names, result.x, errors):
+        row[name] = value
+        row[name + " Error"] = error
+    row["Reduced Chi2"] = chi2
+    row["Status"] = "ok" if result.success else result.message
+    return row
+
+def fit_job(job):
+    run_path, frequency, signal, (t_min, t_max), model = job
+    T, y = load_curve(run_path, frequency, signal)
+    row = fit_window(T, y, t_min, t_max, model)
+    row.update({"Run": run_path, "Frequency": frequency, "Signal": signal})
+    return row
+
+def sliding_windows(t_min, t_max, width, step):
+    """(t_min, t_max) windows of width starting every step from t_min, the last
+    ending at or before t_max"""
+    return [(t, t + width) for t in numpy.arange(t_min, t_max - width + step/2.0, step)]
+
+def pool_map(function, jobs, processes = None):
+    """map of function over jobs spread over a process pool (processes = 1 maps
+    in this process)"""
+    if processes == 1:
+        return map(function, jobs)
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(function, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+def batch_fit(run_paths, windows, frequencies = (1, 2, 4, 8), signal = "R", model = "curie", processes = None):
+    """Fits every combination of run store, frequency and (t_min, t_max) window,
+    spread over a process pool (processes = 1 fits in this process). Returns one
+    row dict per fit."""
+    jobs = [(path, f, signal, tuple(w), model) for path in run_paths for f in frequencies for w in windows]
+    return pool_map(fit_job, jobs, processes)
+
+def write_table(path, rows):
+    """Writes fit rows as CSV, one column per field"""
+    fields = []
+    for row in rows:
+        for field in sorted(row):
+            if field not in fields:
+                fields.append(field)
+    with open(path, 'wb') as f:
+        writer = csv.DictWriter(f, fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+if __name__ == "__main__":
+    # fitting.py OUTPUT.csv T_MIN T_MAX WINDOW_WIDTH WINDOW_STEP COLUMNS_DIRECTORY ...
+    arguments = sys.argv[1:]
+    windows = sliding_windows(*[float(a) for a in arguments[1:5]])
+    rows = batch_fit(arguments[5:], windows)
+    write_table(arguments[0], rows)
+    print "{n} fits written to {p}".format(n = len(rows), p = arguments[0])
@@ -0,0 +1,48 @@
+# HOLDPOWER.py
+# Map from temperature to the steady state heater power that holds it, learned
+# across runs and used as feed-forward when a new setpoint starts
+import os
+import cPickle as pickle
+
+import numpy
+
+import checkpoint
+
+class HoldPowerMap(object):
+    """Hold powers (W) at the temperatures (K) held so far. A new hold within
+    resolution of a known temperature is blended into it with weight, so the
+    map follows slow drifts between cooldowns."""
+    def __init__(self, path = None, resolution = 0.25, weight = 0.5):
+        self.path = path
+        self.resolution = resolution
+        self.weight = weight
+        self.temperatures = []
+        self.powers = []
+        if path is not None and os.path.exists(path):
+            self.temperatures, self.powers = pickle.load(open(path, 'rb'))
+
+    def predict(self, temperature):
+        """Interpolated hold power at temperature, extrapolated linearly from the
+        end points outside the map, or None while the map is empty"""
+        if not self.temperatures:
+            return None
+        if len(self.temperatures) == 1:
+            return self.powers[0]
+        T, P = self.temperatures, self.powers
+        if temperature < T[0]:
+            return P[0] + (temperature - T[0])*(P[1] - P[0])/(T[1] - T[0])
+        if temperature > T[-1]:
+            return P[-1] + (temperature - T[-1])*(P[-1] - P[-2])/(T[-1] - T[-2])
+        return float(numpy.interp(temperature, T, P))
+
+    def update(self, temperature, power):
+        i = numpy.searchsorted(self.temperatures, temperature)
+        for j in (i - 1, i):
+            if 0 <= j < len(self.temperatures) and abs(self.temperatures[j] - temperature) <= self.resolution:
+                self.powers[j] = (1 - self.weight)*self.powers[j] + self.weight*power
+                return
+        self.temperatures.insert(i, temperature)
+        self.powers.insert(i, power)
+
+    def save(self):
+        checkpoint.replace_file(self.path, pickle.dumps((self.temperatures, self.powers)))
@@ -1,33 +1,111 @@
-import visa
 from math import sqrt
+from collections import defaultdict
+import time
+import numpy
 from tempandres import temperature_from_voltage, temperature_from_resistance
 
-rm = visa.ResourceManager()
+try:
+    import visa
+except ImportError:
+    # only the simulated backend can be used without VISA installed
+    visa = None
+
+rm = None
+
+def resource_manager():
+    """Opens the VISA resource manager the first time it is needed"""
+    global rm
+    if rm is None:
+        rm = visa.ResourceManager()
+    return rm
+
+def check_identity(device, identities, name):
+    """Asks a device for its *IDN? and raises RuntimeError unless it names one
+    of identities, so that a warm start never takes another instrument's
+    settings"""
+    identity = device.ask("*IDN?").strip()
+    if not any(expected in identity for expected in identities):
+        raise RuntimeError("{n} answers {i}, expected one of {e}".format(n = name, i = identity, \
+                                                                        e = ", ".join(identities)))
+    return identity
+
+class StateShadow(object):
+    """Remembers the last value written to each setting of an instrument so that
+    writes which would not change anything can be skipped"""
+    def __init__(self, device):
+        self.device = device
+        self.settings = {}
+        self.writes = defaultdict(int)
+        self.skipped = defaultdict(int)
+
+    def write(self, setting, value, command):
+        """Sends command unless setting is already known to be value, returns
+        whether anything was written"""
+        if setting in self.settings and self.settings[setting] == value:
+            self.skipped[setting] += 1
+            return False
+        self.device.write(command)
+        self.settings[setting] = value
+        self.writes[setting] += 1
+        return True
+
+    def load(self, setting, query, parse = float):
+        """Takes the value of setting from the instrument's answer to query, so
+        that a warm start only writes the settings that differ"""
+        self.settings[setting] = parse(self.device.ask(query).strip().strip('"'))
+        return self.settings[setting]
+
+    def invalidate(self, setting = None):
+        """Forgets one setting, or all of them after a reset"""
+        if setting is None:
+            self.settings.clear()
+        else:
+            self.settings.pop(setting, None)
+
+    def statistics(self):
+        return {"writes": sum(self.writes.values()), "skipped": sum(self.skipped.values()), \
+                "skipped by setting": dict(self.skipped)}
 
 class KeithelySourcemeter(object):
-    """Class for the Keithley 2400 Sourcemeter"""
-    def __init__(self, address, resourceManager, name):
+    """Class for the Keithley 2400 Sourcemeter. A warm start leaves the output
+    and voltage as they are, so a restart does not drop the heater, and only
+    sets the source up again if it is not sourcing volts and measuring current."""
+    identities = ("MODEL 2400",)
+    voltage_resolution = 5e-4
+    def __init__(self, address, resourceManager, name, warm = False):
         self.name = name
         self.address = address
         self.device = resourceManager.get_instrument(address)
-
-        self.device.write("*RST")
+        self.shadow = StateShadow(self.device)
+
+        if warm:
+            check_identity(self.device, self.identities, name)
+            self.shadow.load("output", ":OUTP?", lambda reply: reply == "1")
+            self.shadow.load("voltage", ":SOUR:VOLT:LEV?")
+            self.shadow.load("compliance", ":SENS:CURR:PROT?", lambda reply: round(float(reply)*1e3, 6))
+            self.shadow.load("range", ":SENS:CURR:RANG?", lambda reply: round(float(reply)*1e3, 6))
+            configured = self.device.ask(":SOUR:FUNC?").strip() == "VOLT" and \
+                         self.device.ask(":SENS:FUNC?").strip().strip('"').startswith("CURR")
+        else:
+            self.device.write("*RST")
+            configured = False
         self.device.write("*CLS")
-        self.device.write(":SYST:LFR:AUTO ON")
-        self.device.write(":SYST:RSEN OFF")
-        self.device.write(":SOUR:FUNC VOLT")
-        self.device.write(":SOUR:VOLT:MODE FIXED")
-        self.device.write(":SOUR:VOLT:RANG 20")
-        self.set_voltage(0)
-        self.device.write(':SENS:FUNC "CURR"')
-        self.device.write(':FORM:ELEM CURR')
+        if not configured:
+            self.device.write(":SYST:LFR:AUTO ON")
+            self.device.write(":SYST:RSEN OFF")
+            self.device.write(":SOUR:FUNC VOLT")
+            self.device.write(":SOUR:VOLT:MODE FIXED")
+            self.device.write(":SOUR:VOLT:RANG 20")
+            self.set_voltage(0)
+            self.device.write(':SENS:FUNC "CURR"')
+            self.device.write(':FORM:ELEM CURR')
         self.set_compliance_current(100)
 
     def output(self, on):
         if on:
-            self.device.write(":OUTP ON")
+            self.shadow.write("output", True, ":OUTP ON")
         else:
-            self.device.write(":OUTP OFF")
+            self.shadow.write("output", False, ":OUTP OFF")
 
     def read(self):
         data = self.device.write(":READ?")
@@ -35,11 +113,13 @@ class KeithelySourcemeter(object):
         return data
 
     def set_voltage(self, V):
-        self.device.write(":SOUR:VOLT:LEV {voltage}".format(voltage = V))
+        # the 20 V range cannot source finer steps than 500 uV
+        V = round(V/self.voltage_resolution)*self.voltage_resolution
+        self.shadow.write("voltage", V, ":SOUR:VOLT:LEV {voltage}".format(voltage = V))
     
     def set_compliance_current(self, milliamps):
-        self.device.write(":SENS:CURR:PROT {amperage}E-3".format(amperage = milliamps))
-        self.device.write(":SENS:CURR:RANG {amperage}E-3".format(amperage = milliamps))
+        self.shadow.write("compliance", milliamps, ":SENS:CURR:PROT {amperage}E-3".format(amperage = milliamps))
+        self.shadow.write("range", milliamps, ":SENS:CURR:RANG {amperage}E-3".format(amperage = milliamps))
 
 class Heater(object):
     def __init__(self, sourceMeter, resistance):
@@ -57,27 +137,94 @@ class Heater(object):
         self.sourceMeter.set_voltage(sqrt(P*self.resistance))
 
 
+class Reading(object):
+    """The block of samples returned by one triggered multimeter measurement"""
+    def __init__(self, samples):
+        self.samples = numpy.asarray(samples, dtype = float)
+        self.mean = self.samples.mean()
+        self.std = self.samples.std(ddof = 1) if len(self.samples) > 1 else 0.0
+
+class BufferedReading(object):
+    """R and theta stored in the lock-in data buffer at rate Hz. Samples closer
+    together than correlation_time seconds are not independent, so the standard
+    errors count one sample per correlation time at most."""
+    def __init__(self, R, theta, rate, correlation_time = 0):
+        self.R = numpy.asarray(R, dtype = float)
+        self.theta = numpy.asarray(theta, dtype = float)
+        self.rate = rate
+        self.count = len(self.R)
+        self.independent = max(1, min(self.count, self.count/(rate*correlation_time))) if correlation_time > 0 else self.count
+        self.mean = (self.R.mean(), self.theta.mean())
+        if self.count > 1:
+            self.stderr = (self.R.std(ddof = 1)/sqrt(self.independent), self.theta.std(ddof = 1)/sqrt(self.independent))
+        else:
+            self.stderr = (numpy.nan, numpy.nan)
+
 class HPMultimeter(object):
-    """Class for the HP 34401A Multimeter"""
-    def __init__(self, address, resourceManager, name):
+    """Class for the HP 34401A Multimeter. A warm start reads the configured
+    function, sample count and integration time back instead of resetting."""
+    identities = ("34401A",)
+    # CONFigure? answers with the function name alone for DC volts
+    functions = {"VOLT": "VOLT:DC", "VOLT:AC": "VOLT:AC", "FRES": "FRES"}
+    def __init__(self, address, resourceManager, name, warm = False):
         self.name = name
         self.address = address
         self.device = resourceManager.get_instrument(address)
+        self.shadow = StateShadow(self.device)
+        self.configured = None
+        if warm:
+            check_identity(self.device, self.identities, name)
+            self.device.write("*CLS")
+            function = self.shadow.load("function", "CONF?", lambda reply: self.functions.get(reply.split(" ")[0]))
+            self.shadow.load("samples", "SAMP:COUN?", lambda reply: int(float(reply)))
+            if function in ("VOLT:DC", "FRES"):
+                self.shadow.load("nplc", "{f}:NPLC?".format(f = function))
+            return
         self.device.write("*RST")
         self.device.write("*CLS")
         self.device.write("SAMP:COUN 100")
 
-    def measure_voltage(self):
-        reply = self.device.ask_for_values("MEAS:VOLT:DC?")
+    def configure(self, function, samples = 1, nplc = None):
+        """Sets the meter up once for function ("VOLT:DC", "VOLT:AC" or "FRES") so
+        that later readings only need a trigger and a fetch"""
+        if self.shadow.write("function", function, "CONF:{f}".format(f = function)):
+            # CONFigure resets the sample count and integration time
+            self.shadow.invalidate("nplc")
+            self.shadow.invalidate("samples")
+        if nplc is not None:
+            self.shadow.write("nplc", nplc, "{f}:NPLC {n}".format(f = function, n = nplc))
+        self.shadow.write("samples", samples, "SAMP:COUN {n}".format(n = samples))
+        self.configured = function
+
+    def read_samples(self):
+        """Triggers the configured measurement and returns all of its samples"""
+        return Reading(self.device.ask_for_values("READ?"))
+
+    def initiate(self):
+        """Starts the configured measurement without waiting for it, see fetch"""
+        self.device.write("INIT")
+
+    def fetch(self):
+        """Returns the samples of the measurement started by initiate"""
+        return Reading(self.device.ask_for_values("FETCH?"))
+
+    def measure(self, function):
+        if self.configured == function:
+            return self.read_samples().mean
+        # MEASure? reconfigures the meter
+        self.configured = None
+        self.shadow.invalidate()
+        reply = self.device.ask_for_values("MEAS:{f}?".format(f = function))
         return reply[0]
 
+    def measure_voltage(self):
+        return self.measure("VOLT:DC")
+
     def measure_voltage_AC(self):
-        reply = self.device.ask_for_values("MEAS:VOLT:AC?")
-        return reply[0]
+        return self.measure("VOLT:AC")
 
     def measure_resistance(self):
-        reply = self.device.ask_for_values("MEAS:FRES?")
-        return reply[0]
+        return self.measure("FRES")
 
 class KeithleyMultimeter(object):
     def __init__(self, mode, address, resourceManager, name):
@@ -105,16 +252,44 @@ class KeithleyMultimeter(object):
         return self.mode
 
 class SRLockin(object):
-    """Class for the SR 830 Lock-in Amplifier"""
-    def __init__(self, address, resourceManager, name):
+    """Class for the SR 830 Lock-in Amplifier. A warm start reads the reference
+    source, time constant, filter slope and buffer setup back."""
+    identities = ("SR830",)
+    def __init__(self, address, resourceManager, name, warm = False):
         self.address = address
         self.name = name
         self.device = resourceManager.get_instrument(address)
+        self.shadow = StateShadow(self.device)
+        if warm:
+            check_identity(self.device, self.identities, name)
+            self.shadow.load("reference", "FMOD?", int)
+            self.shadow.load("time constant", "OFLT?", int)
+            self.shadow.load("filter slope", "OFSL?", int)
+            self.shadow.load("channel 1", "DDEF? 1", lambda reply: "R" if reply == "1,0" else reply)
+            self.shadow.load("channel 2", "DDEF? 2", lambda reply: "theta" if reply == "1,0" else reply)
+            self.shadow.load("sample rate", "SRAT?", lambda reply: 0.0625*2**int(reply))
+            self.shadow.load("buffer mode", "SEND?", lambda reply: "shot" if reply == "0" else "loop")
         self.device.write("*CLS")
-        self.device.write("FMOD 0")
+        self.shadow.write("reference", 0, "FMOD 0")
+        self.time_constant = None
+        self.filter_slope = self.shadow.settings.get("filter slope")
+        self.buffer_rate = None
 
     def set_time_constant(self, i):
-        self.device.write("OFLT {val}".format(val = i))
+        """Sets the time constant by index, 0 = 10us, 1 = 30us, ... 19 = 30ks"""
+        self.shadow.write("time constant", i, "OFLT {val}".format(val = i))
+        self.time_constant = (1 if i % 2 == 0 else 3) * 10.0**(i//2 - 5)
+
+    def set_filter_slope(self, i):
+        """Sets the low pass filter slope by index, 0 = 6, 1 = 12, 2 = 18, 3 = 24 dB/oct"""
+        self.shadow.write("filter slope", i, "OFSL {val}".format(val = i))
+        self.filter_slope = i
+
+    def get_filter_slope(self):
+        """The filter slope index, asked for once if it was never set or read back"""
+        if self.filter_slope is None:
+            self.filter_slope = int(self.device.ask("OFSL?"))
+        return self.filter_slope
 
     def auto_phase(self):
         self.device.write("APHS")
@@ -122,29 +297,102 @@ class SRLockin(object):
     def auto_gain(self):
         self.device.write("AGAN")
 
+    def wait_until_idle(self, timeout = 30, poll_time = 0.1):
+        """Polls the serial poll status byte until no command is executing (bit
+        1), for auto phase and auto gain, which take a few seconds"""
+        deadline = time.time() + timeout
+        while not int(self.device.ask("*STB?")) & 2 and time.time() < deadline:
+            time.sleep(poll_time)
+
     def read(self):
         return self.device.ask_for_values("SNAP ? 3, 4")
 
+    # buffer sample rates in Hz by SRAT index, 62.5 mHz to 512 Hz
+    sample_rates = dict((0.0625*2**i, i) for i in range(14))
+    buffer_size = 16383
+    # time constants between independent outputs by filter slope index,
+    # 1/(2 x equivalent noise bandwidth) with ENBW = 1/4, 1/8, 3/32 and 5/64
+    # over the time constant for 6, 12, 18 and 24 dB/oct
+    filter_correlation = {0: 2.0, 1: 4.0, 2: 16/3.0, 3: 6.4}
+
+    def configure_buffer(self, rate):
+        """Sets the data buffer up to store R on channel 1 and theta on channel 2
+        at rate Hz (one of sample_rates), stopping once full"""
+        self.shadow.write("channel 1", "R", "DDEF 1,1,0")
+        self.shadow.write("channel 2", "theta", "DDEF 2,1,0")
+        self.shadow.write("sample rate", rate, "SRAT {i}".format(i = self.sample_rates[rate]))
+        self.shadow.write("buffer mode", "shot", "SEND 0")
+        self.buffer_rate = rate
+
+    def start_buffer(self):
+        """Clears the buffer and starts filling it"""
+        self.device.write("REST")
+        self.device.write("STRT")
+
+    def pause_buffer(self):
+        self.device.write("PAUS")
+
+    def buffered_points(self):
+        return int(self.device.ask_for_values("SPTS?")[0])
+
+    def read_trace(self, channel, count, start = 0):
+        """count points of channel from start in one binary transfer of
+        little endian floats"""
+        self.device.write("TRCB? {c},{s},{n}".format(c = channel, s = start, n = count))
+        raw = self.device.read_raw()
+        return numpy.frombuffer(raw[:4*count], dtype = '<f4').astype(float)
+
+    def fetch_buffer(self):
+        """Stops the buffer and returns what it holds as a BufferedReading"""
+        self.pause_buffer()
+        count = self.buffered_points()
+        return BufferedReading(self.read_trace(1, count), self.read_trace(2, count), self.buffer_rate, \
+                               self.filter_correlation[self.get_filter_slope()]*self.time_constant)
+
 class AgilentFunctionGenerator(object):
-    def __init__(self, address, resourceManager, name):
+    """Class for the Agilent 33120A Function Generator. A warm start reads the
+    output back with APPLy? so that apply_settings only changes what differs."""
+    # any 33xxx generator takes APPLy?; the 33120A answers *IDN? as
+    # HEWLETT-PACKARD, the 33220A and later as Agilent or Keysight
+    identities = ("HEWLETT-PACKARD,33", "Agilent Technologies,33", "Keysight Technologies,33")
+    def __init__(self, address, resourceManager, name, warm = False):
         self.address = address
         self.device = resourceManager.get_instrument(address)
+        self.shadow = StateShadow(self.device)
         self.frequency = None
         self.shape = None
         self.amplitude = None
         self.name = name
         self.offset = None
+        if warm:
+            check_identity(self.device, self.identities, name)
+            # e.g. "SIN +2.000000000000000E+03,+1.000000000000000E+00,+0.000000000000000E+00"
+            shape, values = self.device.ask("APPL?").strip().strip('"').split(" ", 1)
+            frequency, amplitude, offset = [float(value) for value in values.split(",")]
+            self.shadow.settings.update({"shape": shape, "frequency": (frequency/1e3, "KHZ"), \
+                                         "amplitude": amplitude, "offset": offset})
         self.device.write("*CLS")
 
     def apply(self, shape = "SIN", freq = (2, "KHZ",), amplitude = 0, offset = 0):
         apply_string = "APPL:{a} {fa} {fb}, {c}, {d}".format(a = shape, fa = freq[0], \
                                                     fb = freq[1], c = amplitude, d = offset)
         self.device.write(apply_string)
+        self.shadow.settings.update({"shape": shape, "frequency": tuple(freq), \
+                                     "amplitude": amplitude, "offset": offset})
 
     def apply_settings(self):
+        """Brings the output in line with the current settings. Once an APPLy has
+        been sent, single settings are changed with their own command, which does
+        not restart the output, and unchanged settings are not sent at all."""
         if (self.shape != None and self.frequency \
             != None and self.amplitude != None and self.offset != None):
-            self.apply(self.shape, self.frequency, self.amplitude, self.offset)
+            if self.shadow.settings.get("shape") != self.shape:
+                self.apply(self.shape, self.frequency, self.amplitude, self.offset)
+                return
+            frequency = tuple(self.frequency)
+            self.shadow.write("frequency", frequency, "FREQ {fa} {fb}".format(fa = frequency[0], fb = frequency[1]))
+            self.shadow.write("amplitude", self.amplitude, "VOLT {a}".format(a = self.amplitude))
+            self.shadow.write("offset", self.offset, "VOLT:OFFS {o}".format(o = self.offset))
         else:
             print("{inst_name} NOT INITIALIZED".format(inst_name = self.name))
 
@@ -176,11 +424,19 @@ class AgilentFunctionGenerator(object):
 
 
 class Thermometer(object):
+    """Diode thermometer. When its multimeter is configured for DC volts every
+    reading averages the configured samples and leaves their spread, in
+    kelvin, in noise."""
     def __init__(self, multimeter, name):
         self.name = name
         self.multimeter = multimeter
+        self.noise = None
 
     def temperature(self):
+        if self.multimeter.configured == "VOLT:DC":
+            temperatures = temperature_from_voltage(self.multimeter.read_samples().samples)
+            self.noise = temperatures.std(ddof = 1) if len(temperatures) > 1 else 0.0
+            return temperatures.mean()
         V = self.multimeter.measure_voltage()
         return temperature_from_voltage(V)
 
@@ -188,7 +444,12 @@ class ResistanceThermometer(object):
     def __init__(self, multimeter, name):
         self.name = name
         self.multimeter = multimeter
+        self.noise = None
 
     def temperature(self):
+        if self.multimeter.configured == "FRES":
+            temperatures = temperature_from_resistance(self.multimeter.read_samples().samples)
+            self.noise = temperatures.std(ddof = 1) if len(temperatures) > 1 else 0.0
+            return temperatures.mean()
         R = self.multimeter.measure_resistance()
         return temperature_from_resistance(R)
@@ -8,28 +8,61 @@ class PIDController():
 		self.integral = 0
 		self.prev_error = 0
 		self.output = 0
+		self.terms = (0, 0, 0)
 		self.first = True
+		# output range of the actuator, the integral is frozen while the output is pinned at either end
+		self.limits = None
 
 	def soft_reset(self):
-		self.lasttime = time.clock()
+		self.lasttime = time.time()
 		self.integral = 0
 		self.output = 0
 		self.prev_error = 0
 		self.first = True
 
+	def set_gains(self, KP, KI, KD):
+		"""Changes the gains without a jump in the integral contribution"""
+		if self.KI != 0 and KI != 0:
+			self.integral *= self.KI/KI
+		self.KP = KP
+		self.KI = KI
+		self.KD = KD
+
+	def preload(self, output):
+		"""Sets the integral term so that it alone produces output, used to feed
+		forward a known hold power"""
+		if self.KI != 0:
+			self.integral = output/self.KI
+
+	def restore(self, integral):
+		"""Restarts the controller with a previously saved integral term"""
+		self.soft_reset()
+		self.integral = integral
+
 	def time_reset(self):
-                self.lasttime = time.clock()
+                self.lasttime = time.time()
 
-	def update(self, measured, setpoint):
+	def update(self, measured, setpoint, rate = None):
+		"""With the rate of change of measured (per second) from an estimator,
+		the derivative term acts on it rather than on differenced errors"""
 		error = setpoint - measured
 		
-		now = time.clock()
+		now = time.time()
 		dt = now - self.lasttime
 		self.lasttime = now
 
 		self.integral += error*dt
-		derivative = (error - self.prev_error)/dt
-		output = self.KP*error + self.KI*self.integral + self.KD*derivative
+		if rate is None:
+			derivative = (error - self.prev_error)/dt
+		else:
+			derivative = -rate
+		# the proportional, integral and derivative contributions, for telemetry
+		self.terms = (self.KP*error, self.KI*self.integral, self.KD*derivative)
+		output = sum(self.terms)
+		if self.limits is not None and (output < self.limits[0] and error < 0 or output > self.limits[1] and error > 0):
+			self.integral -= error*dt
+			self.terms = (self.terms[0], self.KI*self.integral, self.terms[2])
+			output = sum(self.terms)
 		self.prev_error = error
 		if self.first:
                         self.first = False
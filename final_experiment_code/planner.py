@@ -0,0 +1,76 @@
+# PLANNER.py
+# Adaptive choice of setpoints, which packs them where the signal changes fastest
+# (near the transition) and spreads them out where it is flat
+import math
+
+import numpy
+
+class AdaptivePlanner(object):
+    """Setpoints from start_temp up to end_temp, each one step above the last
+    since the stage can only be heated quickly. The step is sized so that none
+    of the signals (point fields) changes by more than about resolution, as a
+    fraction, judged from the slope and curvature of log |signal| over the last
+    three points. The phase starts moving a few kelvin before the magnitude at
+    a sharp transition, so it is watched along with R. Steps stay within
+    min_step and max_step and grow by at most growth per point, so a flat
+    stretch cannot jump far past a transition. With a time_budget (s) the steps
+    are widened, up to max_step, as far as needed to reach end_temp in time at
+    the pace so far."""
+    def __init__(self, start_temp, end_temp, min_step, max_step, signals = ("R2", "Theta2"), \
+                 resolution = 0.02, growth = 1.5, time_budget = None):
+        self.start_temp = start_temp
+        self.end_temp = end_temp
+        self.min_step = min_step
+        self.max_step = max_step
+        self.signals = list(signals)
+        self.resolution = resolution
+        self.growth = growth
+        self.time_budget = time_budget
+        self.start_time = None
+        self.setpoints = []
+        self.values = []
+        self.times = []
+
+    def add(self, setpoint, point, now = None):
+        """Records the point measured at setpoint, finished at time now"""
+        self.setpoints.append(setpoint)
+        self.values.append([abs(point[signal]) for signal in self.signals])
+        self.times.append(now)
+
+    def step(self, now = None):
+        if len(self.setpoints) < 2:
+            return self.min_step
+        T = numpy.array(self.setpoints[-3:])
+        step = self.max_step
+        for y in numpy.log(numpy.maximum(self.values[-3:], 1e-300)).T:
+            slopes = numpy.diff(y)/numpy.diff(T)
+            if slopes[-1] != 0:
+                step = min(step, self.resolution/abs(slopes[-1]))
+            if len(T) == 3:
+                curvature = 2*(slopes[1] - slopes[0])/(T[2] - T[0])
+                if curvature != 0:
+                    step = min(step, math.sqrt(2*self.resolution/abs(curvature)))
+        step = min(step, self.growth*(T[-1] - T[-2]))
+
+        # points recovered from an earlier run carry no time
+        timed = [t for t in self.times if t is not None]
+        if self.time_budget is not None and self.start_time is not None and now is not None and len(timed) > 1:
+            per_point = (timed[-1] - timed[0])/(len(timed) - 1)
+            points_left = (self.time_budget - (now - self.start_time))/per_point
+            step = max(step, (self.end_temp - T[-1])/max(points_left, 1))
+        return min(max(step, self.min_step), self.max_step)
+
+    def next_setpoint(self, now = None):
+        """The setpoint to measure next, or None once end_temp has been measured"""
+        if self.start_time is None:
+            self.start_time = now
+        if not self.setpoints:
+            return self.start_temp
+        last = self.setpoints[-1]
+        if last >= self.end_temp - 1e-9:
+            return None
+        return min(last + self.step(now), self.end_temp)
+
+    def settings(self):
+        return {"min_step": self.min_step, "max_step": self.max_step, "signals": self.signals, \
+                "resolution": self.resolution, "growth": self.growth, "time_budget": self.time_budget}
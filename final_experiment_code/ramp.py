@@ -0,0 +1,30 @@
+# RAMP.py
+# Helpers for continuous ramp acquisition, where the setpoint moves steadily and
+# samples are streamed instead of settling at each temperature
+import numpy
+
+def ramp_setpoint(start_temp, end_temp, rate, elapsed):
+    """Setpoint after elapsed seconds of a ramp at rate K/min, stopping at end_temp"""
+    return min(start_temp + rate*elapsed/60.0, end_temp)
+
+def bin_by_temperature(samples, width, key = "Temperature"):
+    """Averages streamed samples in temperature bins of width K. Every numeric
+    field of the samples is averaged, with its standard error in "<field> Error",
+    and "Count" holds the number of samples in the bin."""
+    if not samples:
+        return []
+    fields = [f for f in samples[0] if isinstance(samples[0][f], (int, long, float))]
+    temperatures = numpy.array([s[key] for s in samples], dtype = float)
+    bins = numpy.floor(temperatures/width).astype(int)
+    labels, index = numpy.unique(bins, return_inverse = True)
+    counts = numpy.bincount(index).astype(float)
+    binned = [{"Count": int(n)} for n in counts]
+    for field in fields:
+        values = numpy.array([s[field] for s in samples], dtype = float)
+        mean = numpy.bincount(index, weights = values)/counts
+        variance = numpy.bincount(index, weights = (values - mean[index])**2)/counts
+        error = numpy.sqrt(variance/numpy.maximum(counts - 1, 1))
+        for b, m, e in zip(binned, mean, error):
+            b[field] = m
+            b[field + " Error"] = e
+    return binned
@@ -0,0 +1,77 @@
+# REDUCTION.py
+# Reduction of many runs at once, as the FullPhaseCorr, FullVolt and FullCurrs
+# notebooks did by hand one run at a time: the lock-in phase offset is removed,
+# R/theta become in-phase and quadrature parts per unit drive current, and the
+# temperatures are carried through a (new) thermometer calibration
+import sys
+
+import numpy
+
+import runstore
+import tempandres
+
+frequencies = (1, 2, 4, 8)
+
+# overall phase (degrees) of the pickup signal with no sample response, see
+# collectDataPoint
+phase_offset = 39.08
+
+def load_runs(run_paths, frequencies = frequencies):
+    """Stacks the temperature, R, theta and drive current of every frequency
+    (kHz) of COLUMNS run stores into arrays of shape (runs, frequencies,
+    points), padding shorter runs and missing columns with NaN. Ramp runs fill
+    the slot of the frequency they were taken at."""
+    schemas = [runstore.read_schema(path) for path in run_paths]
+    shape = (len(run_paths), len(frequencies), max([schema["rows"] for schema in schemas] or [0]))
+    stack = dict((field, numpy.full(shape, numpy.nan)) for field in ("Temperature", "R", "Theta", "Current"))
+    for i, (path, schema) in enumerate(zip(run_paths, schemas)):
+        for j, frequency in enumerate(frequencies):
+            names = runstore.frequency_columns(path, frequency)
+            if names is None:
+                continue
+            columns = runstore.open_run(path, names.values())
+            for field, key in (("Temperature", "Temperature"), ("R", "R"), ("Theta", "Theta"), \
+                               ("Current", "Drive Current RMS")):
+                if key in names:
+                    stack[field][i, j, :schema["rows"]] = columns[names[key]]
+    stack["Points"] = numpy.array([schema["rows"] for schema in schemas])
+    return stack
+
+def correct_phase(R, theta, offset = phase_offset):
+    """In-phase and quadrature parts of R at theta (degrees) less offset, which
+    may be an array broadcasting against them, e.g. one offset per run"""
+    angle = numpy.radians(theta - offset)
+    return R*numpy.cos(angle), R*numpy.sin(angle)
+
+def recalibrate(T, calibration, recorded = tempandres.diode_calibration):
+    """Temperatures read through the recorded calibration, taken back to the
+    thermometer voltages and read again through calibration"""
+    return calibration(recorded.inverse()(T))
+
+def reduce_runs(stack, offset = phase_offset, calibration = None):
+    """Adds the phase corrected X and Y (V per A of drive current) and, given a
+    tempandres.Calibration, the recalibrated temperatures to a stack from
+    load_runs, all in one pass over every run and frequency"""
+    X, Y = correct_phase(stack["R"], stack["Theta"], offset)
+    stack["X"] = X/stack["Current"]
+    stack["Y"] = Y/stack["Current"]
+    if calibration is not None:
+        stack["Temperature"] = recalibrate(stack["Temperature"], calibration)
+    return stack
+
+if __name__ == "__main__":
+    # reduction.py OUTPUT.npz [--phase DEGREES] [--spline] COLUMNS_DIRECTORY ...
+    arguments = sys.argv[2:]
+    offset = phase_offset
+    calibration = None
+    if "--phase" in arguments:
+        i = arguments.index("--phase")
+        offset = float(arguments[i + 1])
+        del arguments[i:i + 2]
+    if "--spline" in arguments:
+        # the monotone cubic through the diode table instead of straight lines
+        arguments.remove("--spline")
+        calibration = tempandres.Calibration(tempandres.therm_voltages, tempandres.therm_temps, spline = True)
+    stack = reduce_runs(load_runs(arguments), offset, calibration)
+    numpy.savez(sys.argv[1], runs = numpy.array(arguments), frequencies = numpy.array(frequencies), **stack)
+    print "{n} runs, {p} points reduced to {o}".format(n = len(arguments), p = stack["Points"].sum(), o = sys.argv[1])
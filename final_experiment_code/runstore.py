@@ -0,0 +1,145 @@
+# RUNSTORE.py
+# Columnar storage for runs: one .npy file per quantity plus a versioned schema,
+# so analysis can memory map just the columns it needs
+import os
+import re
+import sys
+import json
+import cPickle as pickle
+
+import numpy
+
+import checkpoint
+
+schema_version = 1
+schema_file = "SCHEMA"
+columns_directory = "COLUMNS"
+
+# runs before the four frequency sweep measured at the 2 kHz set up by
+# setupExperiment and bracketed each point with a start and end temperature,
+# so the start temperature is the one read with the 2 kHz reading
+legacy_keys = {"Temperature Start": "Temperature2", "Temperature End": "Temperature5", \
+               "R": "R2", "Theta": "Theta2", "Drive Current RMS": "Drive Current RMS2"}
+
+# the temperature read while each drive frequency (kHz) was being measured
+frequency_temperatures = {1: "Temperature1", 2: "Temperature2", 4: "Temperature3", 8: "Temperature4"}
+
+def normalize_record(record):
+    if "Temperature Start" in record:
+        return dict((legacy_keys.get(k, k), v) for k, v in record.items())
+    return record
+
+# a ramp run measures at one drive frequency and stores it under plain names
+ramp_columns = ("Temperature", "R", "Theta", "Drive Current RMS")
+
+def frequency_columns(path, frequency):
+    """Names of the Temperature, R, Theta, Drive Current RMS, R Error and Theta
+    Error columns a COLUMNS run store has at a drive frequency (kHz), or None if
+    the run did not measure at it. A ramp run names its one frequency in the
+    RUNINFO of its run directory."""
+    available = set(column["name"] for column in read_schema(path)["columns"])
+    if "Temperature" in available:
+        import catalog
+        info_path = os.path.join(os.path.dirname(os.path.abspath(path)), catalog.info_file)
+        if not os.path.exists(info_path):
+            raise ValueError("{p} is a ramp run without a {i} giving its drive frequency".format( \
+                p = path, i = catalog.info_file))
+        with open(info_path) as f:
+            if frequency not in json.load(f)["frequencies"]:
+                return None
+        names = dict((name, name) for name in ramp_columns + ("R Error", "Theta Error"))
+    else:
+        names = {"Temperature": frequency_temperatures.get(frequency), "R": "R{f}".format(f = frequency), \
+                 "Theta": "Theta{f}".format(f = frequency), \
+                 "Drive Current RMS": "Drive Current RMS{f}".format(f = frequency), \
+                 "R Error": "R{f} Error".format(f = frequency), "Theta Error": "Theta{f} Error".format(f = frequency)}
+    if names["Temperature"] not in available:
+        return None
+    return dict((key, name) for key, name in names.items() if name in available)
+
+def first_temperature(record):
+    """The first temperature read at a data point, which stands in for its setpoint"""
+    record = normalize_record(record)
+    for frequency in sorted(frequency_temperatures):
+        if frequency_temperatures[frequency] in record:
+            return record[frequency_temperatures[frequency]]
+
+def column_file(name):
+    return re.sub(r'[^A-Za-z0-9]+', '_', name) + ".npy"
+
+def write_run(path, records):
+    """Writes a list of data point dicts as one float64 column per key, with NaN
+    where a point lacks the key. The schema is written last, so a directory
+    without one is incomplete."""
+    records = [normalize_record(r) for r in records]
+    names = []
+    for record in records:
+        for name in sorted(record):
+            if name not in names:
+                names.append(name)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    columns = []
+    for name in names:
+        values = numpy.array([r.get(name, numpy.nan) for r in records], dtype = float)
+        numpy.save(os.path.join(path, column_file(name)), values)
+        columns.append({"name": name, "file": column_file(name), "dtype": str(values.dtype)})
+    schema = {"version": schema_version, "rows": len(records), "columns": columns}
+    with open(os.path.join(path, schema_file), 'w') as f:
+        json.dump(schema, f, indent = 1)
+
+def read_schema(path):
+    with open(os.path.join(path, schema_file)) as f:
+        schema = json.load(f)
+    if schema["version"] > schema_version:
+        raise ValueError("{p} uses run schema version {v}, newer than {s}".format( \
+            p = path, v = schema["version"], s = schema_version))
+    return schema
+
+def open_run(path, columns = None, mmap_mode = 'r'):
+    """Returns a dict of the requested columns (all of them by default) as
+    memory mapped arrays"""
+    schema = read_schema(path)
+    files = dict((c["name"], c["file"]) for c in schema["columns"])
+    if columns is None:
+        columns = [c["name"] for c in schema["columns"]]
+    return dict((name, numpy.load(os.path.join(path, files[name]), mmap_mode = mmap_mode)) \
+                for name in columns)
+
+def open_runs(paths, columns = None):
+    return [open_run(path, columns) for path in paths]
+
+def read_snapshot(inter_directory):
+    """Data list from the newest INCOMPLETEDATA_* pickle of a run, as written
+    before the checkpoint log existed"""
+    indices = []
+    if os.path.exists(inter_directory):
+        for name in os.listdir(inter_directory):
+            if name.startswith("INCOMPLETEDATA_"):
+                indices.append(int(name[len("INCOMPLETEDATA_"):]))
+    if not indices:
+        return []
+    file_path = os.path.join(inter_directory, "INCOMPLETEDATA_{i}".format(i = max(indices)))
+    return pickle.load(open(file_path, 'rb'))
+
+def load_records(run_directory):
+    """The data list of a run directory, from FINALDATA if the run completed or
+    else from its checkpoint log or newest snapshot"""
+    final_path = os.path.join(run_directory, "FINALDATA")
+    if os.path.exists(final_path):
+        return pickle.load(open(final_path, 'rb'))
+    inter_directory = os.path.join(run_directory, "TEMP")
+    records = checkpoint.read_checkpoint(os.path.join(inter_directory, "CHECKPOINT"))
+    return records if records else read_snapshot(inter_directory)
+
+def convert_run(run_directory):
+    """Writes the COLUMNS store of a pickled run directory and returns its path"""
+    path = os.path.join(run_directory, columns_directory)
+    write_run(path, load_records(run_directory))
+    return path
+
+if __name__ == "__main__":
+    # runstore.py RUN_DIRECTORY ...
+    for run_directory in sys.argv[1:]:
+        path = convert_run(run_directory)
+        print "{p}: {n} points".format(p = path, n = read_schema(path)["rows"])
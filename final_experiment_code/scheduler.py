@@ -0,0 +1,90 @@
+# SCHEDULER.py
+# Runs instrument transactions on background threads so that independent GPIB
+# reads can overlap with the settling waits of other instruments
+import sys
+import threading
+import time
+
+class Task(object):
+    """A single instrument call running on its own thread"""
+    def __init__(self, lock, fn, args):
+        self.lock = lock
+        self.fn = fn
+        self.args = args
+        self.value = None
+        self.error = None
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            with self.lock:
+                self.value = self.fn(*self.args)
+        except Exception:
+            self.error = sys.exc_info()
+
+    def done(self):
+        return not self.thread.is_alive()
+
+    def result(self):
+        """Waits for the call to finish and returns its value, re-raising any error"""
+        self.thread.join()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+class InstrumentScheduler(object):
+    """Serializes transactions per instrument while letting different instruments
+    work at the same time"""
+    def __init__(self):
+        self.locks = {}
+        self.guard = threading.Lock()
+
+    def lock(self, instrument):
+        with self.guard:
+            if instrument not in self.locks:
+                self.locks[instrument] = threading.RLock()
+            return self.locks[instrument]
+
+    def run(self, instrument, fn, *args):
+        """Calls fn on the current thread once the instrument is free"""
+        with self.lock(instrument):
+            return fn(*args)
+
+    def submit(self, instrument, fn, *args):
+        """Starts fn in the background and returns a Task for its result"""
+        return Task(self.lock(instrument), fn, args)
+
+class HoldLoop(object):
+    """Calls step every period seconds on a background thread until stopped. An
+    error from step ends the loop and is raised again by stop."""
+    def __init__(self, step, period):
+        self.step = step
+        self.period = period
+        self.stopped = threading.Event()
+        self.thread = None
+        self.error = None
+
+    def start(self):
+        self.stopped.clear()
+        self.error = None
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                self.step()
+                time.sleep(self.period)
+        except Exception:
+            self.error = sys.exc_info()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error[0], error[1], error[2]
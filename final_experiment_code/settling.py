@@ -0,0 +1,62 @@
+# SETTLING.py
+# Decides when a stream of readings (temperatures, lock-in magnitudes) has settled
+from collections import deque
+import time
+
+import numpy
+
+class SettlingDetector(object):
+    """Declares a stream settled once the least squares slope and the spread of
+    the residuals over a rolling window are both within tolerance. Gives up and
+    reports done after timeout seconds regardless. With relative set, the
+    tolerances are fractions of the window mean."""
+    def __init__(self, window, slope_tolerance, std_tolerance, timeout, \
+                 target_tolerance = None, relative = False):
+        self.window = window
+        self.slope_tolerance = slope_tolerance
+        self.std_tolerance = std_tolerance
+        self.target_tolerance = target_tolerance
+        self.timeout = timeout
+        self.relative = relative
+        self.times = deque(maxlen = window)
+        self.values = deque(maxlen = window)
+        self.start = time.time()
+
+    def reset(self):
+        self.times.clear()
+        self.values.clear()
+        self.start = time.time()
+
+    def add(self, value, t = None):
+        if t is None:
+            t = time.time()
+        self.times.append(t)
+        self.values.append(value)
+
+    def statistics(self):
+        """Returns the (mean, slope per second, residual standard deviation) of the window"""
+        t = numpy.array(self.times)
+        v = numpy.array(self.values, dtype = float)
+        t = t - t.mean()
+        mean = v.mean()
+        spread = numpy.dot(t, t)
+        slope = numpy.dot(t, v - mean)/spread if spread > 0 else 0.0
+        residuals = v - mean - slope*t
+        return mean, slope, residuals.std()
+
+    def settled(self, target = None):
+        if len(self.values) < self.window:
+            return False
+        mean, slope, std = self.statistics()
+        scale = abs(mean) if self.relative else 1.0
+        if abs(slope) > self.slope_tolerance*scale or std > self.std_tolerance*scale:
+            return False
+        if target is not None and self.target_tolerance is not None:
+            return abs(mean - target) <= self.target_tolerance
+        return True
+
+    def timed_out(self):
+        return time.time() - self.start > self.timeout
+
+    def done(self, target = None):
+        return self.settled(target) or self.timed_out()
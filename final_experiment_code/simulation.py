@@ -0,0 +1,512 @@
+# SIMULATION.py
+# Simulated instruments and a lumped thermal model of the cryostat, so that the
+# experiment code can be run, profiled and benchmarked without the hardware
+import os
+import sys
+import math
+import random
+import shutil
+import struct
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+from tempandres import voltage_from_temperature
+import experiment, instruments, pid, scheduler, settling, autotune, tracing, estimator
+
+class VirtualClock(object):
+    """Stand-in for the time module that runs speedup times faster than real time.
+    Sleeps are shortened and time()/clock() are scaled, so concurrent threads keep
+    a consistent timeline."""
+    def __init__(self, speedup = 100.0):
+        self.speedup = float(speedup)
+        self.real_start = time.time()
+        self.start = self.real_start
+
+    def time(self):
+        return self.start + (time.time() - self.real_start)*self.speedup
+
+    def clock(self):
+        return self.time() - self.start
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds/self.speedup)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+def use_clock(clock, modules):
+    """Points the time module of every module in modules at clock and returns the
+    previous values so they can be restored with restore_clock"""
+    previous = [(module, module.time) for module in modules]
+    for module in modules:
+        module.time = clock
+    return previous
+
+def restore_clock(previous):
+    for module, clock in previous:
+        module.time = clock
+
+class ThermalPlant(object):
+    """Sample stage with heat capacity C (J/K) linked to a bath at bath (K) through
+    a thermal conductance G (W/K). The heater power reaches the stage through a
+    first order lag of lag seconds, which stands in for the heater block and
+    the thermometer mounting."""
+    def __init__(self, clock, T = 77.35, bath = 77.35, C = 0.4, G = 0.004, lag = 4.0):
+        self.clock = clock
+        self.T = T
+        self.bath = bath
+        self.C = C
+        self.G = G
+        self.lag = lag
+        self.heater_power = 0.0
+        self.delivered = G*(T - bath)
+        self.last = clock.time()
+        self.lock = threading.Lock()
+
+    def temperature(self):
+        with self.lock:
+            now = self.clock.time()
+            steps = int(math.ceil(min(now - self.last, 1000.0)/0.05))
+            h = (now - self.last)/steps if steps else 0
+            for i in range(steps):
+                self.delivered += (self.heater_power - self.delivered)*(1 - math.exp(-h/self.lag))
+                # exact solution for constant power over the step
+                T_final = self.bath + self.delivered/self.G
+                self.T = T_final + (self.T - T_final)*math.exp(-h*self.G/self.C)
+            self.last = now
+            return self.T
+
+    def set_power(self, P):
+        self.temperature()
+        with self.lock:
+            self.heater_power = P
+
+class SampleModel(object):
+    """Mutual inductance response of a sample with a Curie transition at Tc, the
+    susceptibility follows (T - Tc)^-gamma above Tc and saturates below it"""
+    def __init__(self, Tc = 130.0, gamma = 1.3, A = 2e-3, width = 0.5, phase = 39.08, noise = 2e-3):
+        self.Tc = Tc
+        self.gamma = gamma
+        self.A = A
+        self.width = width
+        self.phase = phase
+        self.noise = noise
+
+    def susceptibility(self, T):
+        return self.A/(max(T - self.Tc, 0) + self.width)**self.gamma
+
+    def response(self, T, frequency, current):
+        """Returns the (R, theta) seen by the lock-in, frequency in Hz and current in A rms"""
+        chi = self.susceptibility(T)
+        R = chi*current*frequency*1e-2*(1 + random.gauss(0, self.noise))
+        loss = 20*math.exp(-((T - self.Tc)/(5*self.width))**2)
+        theta = self.phase - loss - 0.5*math.log(frequency/1000.0) + random.gauss(0, 0.02)
+        return R, theta
+
+def parse_frequency(value, unit = "HZ"):
+    scale = {"HZ": 1.0, "KHZ": 1e3, "MHZ": 1e6}[unit.upper()]
+    return float(value)*scale
+
+class SimulatedDevice(object):
+    """Base class emulating the command traffic of a GPIB instrument. Every
+    transaction costs bus_latency plus the per-command latency in latencies."""
+    bus_latency = 0.002
+    latencies = {}
+
+    def __init__(self, rig, address):
+        self.rig = rig
+        self.address = address
+        self.response = ""
+
+    def transaction(self, command):
+        command = command.strip()
+        head = command.split(" ")[0].upper()
+        latency = self.bus_latency + self.latency(head)
+        self.rig.record(self.address, head, latency)
+        self.rig.clock.sleep(latency)
+        return command, head
+
+    def latency(self, head):
+        return self.latencies.get(head, 0.005)
+
+    def write(self, command):
+        command, head = self.transaction(command)
+        reply = self.handle(command, head)
+        if reply is not None:
+            self.response = reply
+
+    def read(self):
+        self.transaction("READ")
+        response, self.response = self.response, ""
+        return response
+
+    read_raw = read
+
+    def ask(self, command):
+        self.write(command)
+        return self.read()
+
+    def ask_for_values(self, command):
+        return [float(value) for value in self.ask(command).split(",") if value.strip()]
+
+    def handle(self, command, head):
+        """Acts on the command, returning the reply string for queries"""
+        if head == "*IDN?":
+            return self.identity
+        return None
+
+def format_values(values):
+    return ",".join("{v:.8E}".format(v = v) for v in values)
+
+class SimulatedMultimeter(SimulatedDevice):
+    """HP 34401A, probe returns the (DC, AC rms) voltages at its input"""
+    identity = "HEWLETT-PACKARD,34401A,0,11-5-2"
+    latencies = {"*RST": 0.5, "MEAS:VOLT:DC?": 0.05, "MEAS:VOLT:AC?": 0.05, "MEAS:FRES?": 0.05}
+    ac_settle_time = 1.0 # medium AC filter
+
+    def __init__(self, rig, address, probe):
+        SimulatedDevice.__init__(self, rig, address)
+        self.probe = probe
+        self.reset()
+
+    def reset(self):
+        self.function = "VOLT:DC"
+        self.sample_count = 1
+        self.nplc = 10
+        self.started = None
+
+    def measurement_time(self):
+        settle_time = self.ac_settle_time if self.function == "VOLT:AC" else 0
+        return settle_time + self.sample_count*self.nplc/60.0
+
+    def samples(self):
+        values = []
+        for i in range(self.sample_count):
+            dc, ac = self.probe()
+            values.append(ac if self.function == "VOLT:AC" else dc)
+        return values
+
+    def measure(self, head):
+        self.rig.record(self.address, head, self.measurement_time(), 0)
+        self.rig.clock.sleep(self.measurement_time())
+        return format_values(self.samples())
+
+    def handle(self, command, head):
+        if head == "*RST":
+            self.reset()
+        elif head == "*CLS":
+            pass
+        elif head == "SAMP:COUN":
+            self.sample_count = int(command.split(" ")[1])
+        elif head == "SAMP:COUN?":
+            return "{n:+.8E}".format(n = self.sample_count)
+        elif head == "CONF?":
+            function = "VOLT" if self.function == "VOLT:DC" else self.function
+            return '"{f} +1.000000E+01,+3.000000E-06"'.format(f = function)
+        elif head.endswith(":NPLC?"):
+            return "{n:+.8E}".format(n = self.nplc)
+        elif head.startswith("CONF:"):
+            # CONFigure restores the defaults for the new function
+            self.reset()
+            self.function = head[len("CONF:"):]
+        elif head.endswith(":NPLC"):
+            self.nplc = float(command.split(" ")[1])
+        elif head.startswith("MEAS:"):
+            # MEASure? is CONFigure followed by READ?
+            self.reset()
+            self.function = head[len("MEAS:"):-1]
+            return self.measure(head)
+        elif head == "READ?":
+            return self.measure(head)
+        elif head == "INIT":
+            self.started = self.rig.clock.time()
+        elif head == "FETCH?":
+            remaining = self.started + self.measurement_time() - self.rig.clock.time()
+            self.rig.record(self.address, head, max(remaining, 0), 0)
+            self.rig.clock.sleep(remaining)
+            return format_values(self.samples())
+        else:
+            return SimulatedDevice.handle(self, command, head)
+        return None
+
+class SimulatedSourcemeter(SimulatedDevice):
+    """Keithley 2400 driving the heater resistor"""
+    identity = "KEITHLEY INSTRUMENTS INC.,MODEL 2400,0,C30"
+    latencies = {"*RST": 0.5}
+
+    def __init__(self, rig, address, heater_resistance):
+        SimulatedDevice.__init__(self, rig, address)
+        self.heater_resistance = heater_resistance
+        self.reset()
+
+    def reset(self):
+        self.voltage = 0.0
+        self.output = False
+        self.source_function = "VOLT"
+        self.sense_function = "VOLT:DC"
+        self.compliance = 1.05e-4
+
+    def update_power(self):
+        power = self.voltage**2/self.heater_resistance if self.output else 0.0
+        self.rig.plant.set_power(power)
+
+    def handle(self, command, head):
+        queries = {":OUTP?": lambda: "1" if self.output else "0", \
+                   ":SOUR:VOLT:LEV?": lambda: "{v:+.6E}".format(v = self.voltage), \
+                   ":SOUR:FUNC?": lambda: self.source_function, \
+                   ":SENS:FUNC?": lambda: '"{f}"'.format(f = self.sense_function), \
+                   ":SENS:CURR:PROT?": lambda: "{c:+.6E}".format(c = self.compliance), \
+                   ":SENS:CURR:RANG?": lambda: "{c:+.6E}".format(c = self.compliance)}
+        if head in queries:
+            return queries[head]()
+        if head == "*RST":
+            self.reset()
+        elif head == ":SOUR:FUNC":
+            self.source_function = command.split(" ")[1]
+        elif head == ":SENS:FUNC":
+            self.sense_function = command.split(" ")[1].strip('"') + ":DC"
+        elif head == ":SENS:CURR:PROT":
+            self.compliance = float(command.split(" ")[1])
+        elif head == ":SOUR:VOLT:LEV":
+            self.voltage = float(command.split(" ")[1])
+        elif head == ":OUTP":
+            self.output = command.split(" ")[1].upper() == "ON"
+        elif head == ":READ?":
+            current = self.voltage/self.heater_resistance if self.output else 0.0
+            return format_values([current])
+        else:
+            return SimulatedDevice.handle(self, command, head)
+        self.update_power()
+        return None
+
+class SimulatedLockin(SimulatedDevice):
+    """SR830 whose output relaxes towards the sample response with the selected
+    time constant after every frequency or gain change. The data buffer holds
+    R and theta sampled at the buffer rate while it runs."""
+    identity = "Stanford_Research_Systems,SR830,s/n00000,ver1.07"
+    latencies = {"SNAP": 0.01, "TRCB?": 0.02}
+    # seconds an auto phase or auto gain keeps the lock-in busy
+    busy_times = {"APHS": 2.0, "AGAN": 3.0}
+
+    def __init__(self, rig, address):
+        SimulatedDevice.__init__(self, rig, address)
+        self.time_constant_index = 8
+        self.time_constant = 0.1
+        self.filter_slope_index = 1
+        self.reference = 1
+        self.previous = (0.0, 0.0)
+        self.disturbed = rig.clock.time()
+        self.busy_until = 0
+        self.channels = {1: "0,0", 2: "0,0"}
+        self.buffer_mode = 1
+        self.buffer_rate_index = 4
+        self.buffer_rate = 1.0
+        self.buffer = []
+        self.started = None
+        self.paused = None
+
+    def disturb(self):
+        self.previous = self.output()
+        self.disturbed = self.rig.clock.time()
+
+    def output(self):
+        target = self.rig.sample.response(self.rig.plant.temperature(), \
+                                          self.rig.function_generator.frequency, \
+                                          self.rig.drive_current())
+        # a 24 dB/oct filter needs about 10 time constants to settle
+        decay = math.exp(-(self.rig.clock.time() - self.disturbed)/(2.5*self.time_constant))
+        return tuple(t + (p - t)*decay for t, p in zip(target, self.previous))
+
+    def buffered_points(self):
+        """Points stored so far, filling the buffer with outputs up to that count"""
+        if self.started is None:
+            return 0
+        end = self.paused if self.paused is not None else self.rig.clock.time()
+        count = min(int((end - self.started)*self.buffer_rate), 16383)
+        while len(self.buffer) < count:
+            self.buffer.append(self.output())
+        return count
+
+    def handle(self, command, head):
+        queries = {"OFLT?": self.time_constant_index, "OFSL?": self.filter_slope_index, "FMOD?": self.reference, \
+                   "SRAT?": self.buffer_rate_index, "SEND?": self.buffer_mode, "*STB?": 0 if self.rig.clock.time() < self.busy_until else 2}
+        if head in queries:
+            return str(queries[head])
+        if head == "DDEF?":
+            return self.channels[int(command.split(" ")[1])]
+        if head == "OFLT":
+            i = self.time_constant_index = int(command.split(" ")[1])
+            self.time_constant = (1 if i % 2 == 0 else 3) * 10.0**(i//2 - 5)
+            return None
+        if head == "OFSL":
+            self.filter_slope_index = int(command.split(" ")[1])
+            return None
+        if head == "SRAT":
+            self.buffer_rate_index = int(command.split(" ")[1])
+            self.buffer_rate = 0.0625*2**self.buffer_rate_index
+            return None
+        if head == "REST":
+            self.buffer, self.started, self.paused = [], None, None
+            return None
+        if head == "STRT":
+            self.started = self.rig.clock.time()
+            return None
+        if head == "PAUS":
+            self.buffered_points()
+            self.paused = self.rig.clock.time()
+            return None
+        if head == "SPTS?":
+            return str(self.buffered_points())
+        if head == "TRCB?":
+            channel, start, count = [int(value) for value in command.split(" ")[1].split(",")]
+            self.buffered_points()
+            values = [point[channel - 1] for point in self.buffer[start:start + count]]
+            return struct.pack("<{n}f".format(n = len(values)), *values)
+        if head == "DDEF":
+            channel, display = command.split(" ")[1].split(",", 1)
+            self.channels[int(channel)] = display
+            return None
+        if head == "SEND":
+            self.buffer_mode = int(command.split(" ")[1])
+            return None
+        if head in ("AGAN", "APHS"):
+            self.disturb()
+            self.busy_until = self.rig.clock.time() + self.busy_times[head]
+            return None
+        if head == "SNAP":
+            return format_values(self.output())
+        if head == "FMOD":
+            self.reference = int(command.split(" ")[1])
+            return None
+        if head == "*CLS":
+            return None
+        return SimulatedDevice.handle(self, command, head)
+
+class SimulatedFunctionGenerator(SimulatedDevice):
+    """Agilent 33120A style function generator driving the primary coil"""
+    identity = "HEWLETT-PACKARD,33120A,0,8.0-5.0-1.0"
+    latencies = {"APPL:SIN": 0.05}
+
+    def __init__(self, rig, address):
+        SimulatedDevice.__init__(self, rig, address)
+        self.shape = "SIN"
+        self.frequency = 1000.0
+        self.amplitude = 0.1
+        self.offset = 0.0
+
+    def handle(self, command, head):
+        if head == "APPL?":
+            return '"{s} {f:+.15E},{a:+.15E},{o:+.15E}"'.format(s = self.shape, f = self.frequency, \
+                                                               a = self.amplitude, o = self.offset)
+        if head.startswith("APPL:"):
+            self.shape = head[len("APPL:"):]
+            arguments = command[len(head):].split(",")
+            frequency = arguments[0].split()
+            self.frequency = parse_frequency(*frequency)
+            self.amplitude = float(arguments[1])
+            self.offset = float(arguments[2])
+            self.rig.lock_in.disturb()
+            return None
+        if head == "FREQ":
+            self.frequency = parse_frequency(*command.split()[1:])
+            self.rig.lock_in.disturb()
+        elif head == "VOLT":
+            self.amplitude = float(command.split()[1])
+        elif head == "VOLT:OFFS":
+            self.offset = float(command.split()[1])
+        elif head != "*CLS":
+            return SimulatedDevice.handle(self, command, head)
+        return None
+
+class SimulatedRig(object):
+    """The cryostat as wired in setupExperiment, with one simulated device per address"""
+    def __init__(self, clock = None, plant = None, sample = None, drive_resistor = 98.8, \
+                 coil_resistance = 900.0, heater_resistance = 90.0, thermometer_noise = 2e-5):
+        self.clock = clock if clock is not None else VirtualClock(1)
+        self.plant = plant if plant is not None else ThermalPlant(self.clock)
+        self.sample = sample if sample is not None else SampleModel()
+        self.drive_resistor = drive_resistor
+        self.coil_resistance = coil_resistance
+        self.thermometer_noise = thermometer_noise
+        self.traffic = defaultdict(int)
+        self.bus_time = defaultdict(float)
+        self.traffic_lock = threading.Lock()
+
+        self.lock_in = SimulatedLockin(self, "GPIB0::5::INSTR")
+        self.function_generator = SimulatedFunctionGenerator(self, "GPIB0::3::INSTR")
+        self.devices = {
+            "GPIB0::1::INSTR": SimulatedMultimeter(self, "GPIB0::1::INSTR", self.thermometer_probe),
+            "GPIB0::2::INSTR": SimulatedMultimeter(self, "GPIB0::2::INSTR", self.drive_probe),
+            "GPIB0::3::INSTR": self.function_generator,
+            "GPIB0::4::INSTR": SimulatedSourcemeter(self, "GPIB0::4::INSTR", heater_resistance),
+            "GPIB0::5::INSTR": self.lock_in}
+
+    def record(self, address, head, latency, count = 1):
+        with self.traffic_lock:
+            self.traffic[(address, head)] += count
+            self.bus_time[(address, head)] += latency
+
+    def drive_current(self):
+        V_rms = self.function_generator.amplitude/(2*math.sqrt(2))
+        return V_rms/(self.drive_resistor + self.coil_resistance)
+
+    def thermometer_probe(self):
+        V = voltage_from_temperature(self.plant.temperature())
+        return V + random.gauss(0, self.thermometer_noise), 0.0
+
+    def drive_probe(self):
+        V = self.drive_current()*self.drive_resistor
+        return self.function_generator.offset, V*(1 + random.gauss(0, 1e-4))
+
+class SimulatedResourceManager(object):
+    """Drop-in replacement for visa.ResourceManager backed by a SimulatedRig"""
+    def __init__(self, rig = None):
+        self.rig = rig if rig is not None else SimulatedRig()
+
+    def get_instrument(self, address):
+        return self.rig.devices[address]
+
+    open_resource = get_instrument
+
+    def list_resources(self):
+        return tuple(sorted(self.rig.devices))
+
+def benchmark(start_temp = 100, end_temp = 110, temp_res = 1, speedup = 100.0, base_directory = None, \
+              tracer = None, planner = None):
+    """Runs a full simulated sweep and returns its duration in simulated and real
+    seconds along with the instrument traffic. A tracing.Tracer given as tracer
+    records the sweep in simulated time, and a planner.AdaptivePlanner chooses
+    the setpoints instead of the temp_res grid."""
+    clock = VirtualClock(speedup)
+    rig = SimulatedRig(clock, ThermalPlant(clock, T = start_temp - 3))
+    rm = SimulatedResourceManager(rig)
+    # a fresh directory also means no hold powers learned by earlier benchmarks
+    directory = base_directory if base_directory is not None else os.path.join(tempfile.mkdtemp(), "RUN")
+    previous = use_clock(clock, [experiment, instruments, pid, scheduler, settling, autotune, tracing, estimator])
+    experiment.default_rig.tracer = tracer
+    try:
+        start, real_start = clock.time(), time.time()
+        experiment.runExperiment(start_temp, end_temp, temp_res, directory, resource_manager = rm, planner = planner)
+        duration, real_duration = clock.time() - start, time.time() - real_start
+    finally:
+        restore_clock(previous)
+        experiment.default_rig.tracer = None
+        if base_directory is None:
+            shutil.rmtree(os.path.dirname(directory))
+    return {"duration": duration, "real duration": real_duration, "points": len(experiment.data), \
+            "traffic": dict(rig.traffic), "bus time": dict(rig.bus_time), \
+            "writes": experiment.writeStatistics()}
+
+if __name__ == "__main__":
+    arguments = [float(a) for a in sys.argv[1:]]
+    results = benchmark(*arguments)
+    print "Simulated sweep of {n} points took {d:.0f} s ({r:.1f} s real)".format( \
+        n = results["points"], d = results["duration"], r = results["real duration"])
+    total = sum(results["bus time"].values())
+    print "{c} transactions, {t:.0f} s of bus time".format(c = sum(results["traffic"].values()), t = total)
+    for key in sorted(results["bus time"], key = results["bus time"].get, reverse = True):
+        print "  {a} {h:<16} {n:6d} {t:8.1f} s".format(a = key[0], h = key[1], \
+                                                    n = results["traffic"][key], t = results["bus time"][key])
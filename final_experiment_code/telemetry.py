@@ -0,0 +1,168 @@
+# TELEMETRY.py
+# Live stream of structured samples from a run. The control loop only queues
+# samples; a background thread writes them to the console, a file ring and a
+# local UDP port, and a subscriber can tail or plot the stream.
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import Queue
+
+class Publisher(object):
+    """Queues samples (dicts of time, kind and fields) for a background thread.
+    The queue holds at most capacity samples; when the outputs fall behind new
+    samples are dropped and counted rather than blocking the caller. Samples go
+    to the console if console is set, as JSON lines to path (rotated to path.1
+    every max_lines) and as JSON datagrams to port on localhost."""
+    def __init__(self, console = True, path = None, port = None, capacity = 1000, max_lines = 100000):
+        self.console = console
+        self.path = path
+        self.port = port
+        self.max_lines = max_lines
+        self.queue = Queue.Queue(capacity)
+        self.dropped = 0
+        self.thread = None
+        self.start_lock = threading.Lock()
+        self.file = None
+        self.lines = 0
+        self.socket = None
+
+    def publish(self, kind, **fields):
+        fields["kind"] = kind
+        fields.setdefault("time", time.time())
+        self.start()
+        try:
+            self.queue.put_nowait(fields)
+        except Queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        with self.start_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target = self.run, name = "telemetry")
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        while True:
+            sample = self.queue.get()
+            try:
+                self.write(sample)
+            except Exception as error:
+                # output trouble must never reach the experiment
+                sys.stderr.write("telemetry: {e}\n".format(e = error))
+            finally:
+                self.queue.task_done()
+
+    def write(self, sample):
+        if self.console:
+            print format_sample(sample)
+        if self.path is not None or self.port is not None:
+            line = json.dumps(sample)
+        if self.path is not None:
+            if self.file is None or self.lines >= self.max_lines:
+                self.rotate()
+            self.file.write(line + "\n")
+            self.file.flush()
+            self.lines += 1
+        if self.port is not None:
+            if self.socket is None:
+                self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                self.socket.sendto(line, ("127.0.0.1", self.port))
+            except socket.error:
+                pass # nobody listening
+
+    def rotate(self):
+        if self.file is not None:
+            self.file.close()
+            if os.name == 'nt' and os.path.exists(self.path + ".1"):
+                os.remove(self.path + ".1")
+            os.rename(self.path, self.path + ".1")
+        self.file = open(self.path, 'a')
+        self.lines = 0
+
+    def flush(self):
+        """Waits until every queued sample has been written"""
+        if self.thread is not None:
+            self.queue.join()
+
+def format_sample(sample):
+    """One line of console output for a sample"""
+    prefix = "{r}: ".format(r = sample["rig"]) if sample.get("rig") is not None else ""
+    kind = sample["kind"]
+    if kind == "message":
+        return prefix + sample["text"]
+    if kind == "control":
+        line = "{T:.4f} K".format(T = sample["temperature"])
+        if sample.get("setpoint") is not None:
+            line += " -> {s:.3f} K".format(s = sample["setpoint"])
+        if sample.get("power") is not None:
+            line += "  {p:.4f} W".format(p = sample["power"])
+        return prefix + line
+    if kind == "lock-in":
+        return prefix + "{f} kHz  R {R:.6g}  theta {t:.3f}".format(f = sample["frequency"], R = sample["R"], \
+                                                                   t = sample["theta"])
+    fields = ", ".join("{k} {v}".format(k = k, v = sample[k]) for k in sorted(sample) if k not in ("kind", "rig", "time"))
+    return prefix + "{k}: {f}".format(k = kind, f = fields)
+
+def subscribe(port):
+    """Yields the samples published to port on localhost"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listener.bind(("127.0.0.1", port))
+    while True:
+        data, sender = listener.recvfrom(65536)
+        yield json.loads(data)
+
+def follow(path, poll_time = 0.5):
+    """Yields the samples written to the file ring at path, starting at its end
+    and reopening it when it is rotated"""
+    f = open(path)
+    f.seek(0, os.SEEK_END)
+    while True:
+        line = f.readline()
+        if line.endswith("\n"):
+            yield json.loads(line)
+            continue
+        if line:
+            f.seek(-len(line), os.SEEK_CUR)
+        if os.path.exists(path) and os.path.getsize(path) < f.tell():
+            f.close()
+            f = open(path)
+        time.sleep(poll_time)
+
+def plot(samples, window = 600):
+    """Live plot of the temperature and heater power of the last window seconds"""
+    import matplotlib.pyplot as plt
+    plt.ion()
+    figure, (temperature_axes, power_axes) = plt.subplots(2, 1, sharex = True)
+    times, temperatures, powers = [], [], []
+    last_draw = 0
+    for sample in samples:
+        if sample["kind"] != "control":
+            continue
+        times.append(sample["time"])
+        temperatures.append(sample["temperature"])
+        powers.append(sample.get("power"))
+        while times[-1] - times[0] > window:
+            del times[0], temperatures[0], powers[0]
+        if time.time() - last_draw > 1:
+            temperature_axes.cla()
+            power_axes.cla()
+            temperature_axes.plot(times, temperatures)
+            power_axes.plot(times, powers)
+            temperature_axes.set_ylabel("T (K)")
+            power_axes.set_ylabel("Heater power (W)")
+            plt.pause(0.01)
+            last_draw = time.time()
+
+if __name__ == "__main__":
+    # telemetry.py PORT|FILE [--plot]
+    source = sys.argv[1]
+    samples = subscribe(int(source)) if source.isdigit() else follow(source)
+    if "--plot" in sys.argv[2:]:
+        plot(samples)
+    for sample in samples:
+        print format_sample(sample)
@@ -1,5 +1,7 @@
 # TEMPANDRES.py
 # Defines auxilliary functions to handle resistivity calculations at various temperatures
+import os
+import numpy
 from numpy import interp
 
 therm_voltages = [1.644290, 1.642990, 1.641570, 1.640030, 1.638370, 1.636600, 1.634720, 1.632740, 1.630670, 1.628520, 1.626290, 1.624000, 1.621660, 1.619280, 1.616870, 1.614450, 1.612000, 1.609510, 1.606970, 1.604380, 1.601730, 1.599020, 1.596260, 1.59344, 1.59057, 1.58764, 1.58465, 1.57848, 1.57202, 1.56533, 1.55845, 1.55145, 1.54436, 1.53721, 1.53000, 1.52273, 1.51541, 1.49698, 1.47868, 1.46086, 1.44374, 1.42747, 1.41207, 1.39751, 1.38373, 1.37065, 1.35820, 1.34632, 1.33499, 1.32416, 1.31381, 1.30390, 1.29439, 1.28526, 1.27645, 1.26794, 1.25967, 1.25161, 1.24372, 1.23596, 1.22830, 1.22070, 1.21311, 1.20548, 1.197748, 1.181548, 1.162797, 1.140817, 1.125923, 1.119448, 1.115658, 1.112810, 1.110421, 1.108261, 1.106244, 1.104324, 1.102476, 1.100681, 1.098930, 1.097216, 1.095534, 1.093878, 1.092244, 1.090627, 1.089024, 1.085842, 1.082669, 1.079492, 1.076303, 1.073099, 1.069881, 1.066650, 1.063403, 1.060141, 1.056862, 1.048584, 1.040183, 1.031651, 1.027594, 1.022984, 1.014181, 1.005244, 0.986974, 0.968209, 0.949000, 0.929390, 0.909416, 0.889114, 0.868518, 0.847659, 0.826560, 0.805242, 0.783720, 0.762007, 0.740115, 0.718054, 0.695834, 0.673462, 0.650949, 0.628302, 0.621141, 0.605528, 0.582637, 0.559639, 0.536542, 0.513361, 0.490106, 0.466760, 0.443371, 0.419960, 0.396503, 0.373002, 0.349453, 0.325839, 0.302161, 0.278416, 0.254592, 0.230697, 0.206758, 0.182832, 0.159010, 0.135480, 0.112553, 0.090681]
@@ -29,17 +31,101 @@ nichrome_resistivity = zip(nichrome_resistivity_t, nichrome_resistivity_rho)
 
 resistivity_tables = {"Copper": copper_resistivity, "Nichrome": nichrome_resistivity}
 
+def monotone_slopes(x, y):
+    """Knot slopes of the Fritsch-Carlson monotone cubic through (x, y)"""
+    h = numpy.diff(x)
+    delta = numpy.diff(y)/h
+    slopes = numpy.empty_like(y)
+    slopes[0] = delta[0]
+    slopes[-1] = delta[-1]
+    w1 = 2*h[1:] + h[:-1]
+    w2 = h[1:] + 2*h[:-1]
+    same_sign = delta[:-1]*delta[1:] > 0
+    with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+        mean = (w1 + w2)/(w1/delta[:-1] + w2/delta[1:])
+    slopes[1:-1] = numpy.where(same_sign, mean, 0.0)
+    return slopes
+
+class Calibration(object):
+    """Calibration table mapping x to y. The table is stored once as contiguous
+    float arrays sorted by x, and is evaluated by linear interpolation or, with
+    spline set, by a monotone cubic. Accepts scalars or arrays of any shape and,
+    like numpy.interp, clamps to the end values outside the table."""
+    def __init__(self, x, y, spline = False):
+        x = numpy.asarray(x, dtype = float)
+        y = numpy.asarray(y, dtype = float)
+        order = numpy.argsort(x)
+        self.x = numpy.ascontiguousarray(x[order])
+        self.y = numpy.ascontiguousarray(y[order])
+        self.spline = spline
+        self.slopes = monotone_slopes(self.x, self.y) if spline else None
+        self._inverse = None
+
+    @classmethod
+    def from_file(cls, path, x_column = 0, y_column = 1, spline = False):
+        columns = load_table(path)
+        return cls(columns[x_column], columns[y_column], spline)
+
+    def __call__(self, x):
+        if not self.spline:
+            return interp(x, self.x, self.y)
+        x = numpy.clip(numpy.asarray(x, dtype = float), self.x[0], self.x[-1])
+        i = numpy.clip(numpy.searchsorted(self.x, x) - 1, 0, len(self.x) - 2)
+        h = self.x[i + 1] - self.x[i]
+        t = (x - self.x[i])/h
+        y = (2*t**3 - 3*t**2 + 1)*self.y[i] + (t**3 - 2*t**2 + t)*h*self.slopes[i] + \
+            (-2*t**3 + 3*t**2)*self.y[i + 1] + (t**3 - t**2)*h*self.slopes[i + 1]
+        return y if y.ndim else float(y)
+
+    def inverse(self):
+        """The calibration from y back to x, built on first use and then cached.
+        Only meaningful for a monotone table."""
+        if self._inverse is None:
+            self._inverse = Calibration(self.y, self.x, self.spline)
+            self._inverse._inverse = self
+        return self._inverse
+
+def load_table(path):
+    """Reads a table of numbers from a text file as a list of column arrays.
+    Columns may be laid out side by side on each line, or one after another in
+    blocks separated by blank lines as in plat.txt."""
+    rows = []
+    blocks = [[]]
+    for line in open(path, 'rb').read().decode('cp1252').splitlines():
+        # plat.txt writes negative numbers with an en dash
+        fields = line.replace(u'\u2013', '-').replace(',', ' ').split()
+        if not fields:
+            if blocks[-1]:
+                blocks.append([])
+            continue
+        rows.append([float(f) for f in fields])
+        blocks[-1].append(rows[-1])
+    if not blocks[-1]:
+        blocks.pop()
+    if all(len(row) == 1 for row in rows) and len(blocks) > 1:
+        return [numpy.array([row[0] for row in block]) for block in blocks]
+    return [numpy.array(column) for column in zip(*rows)]
+
+def load_platinum_calibration(path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plat.txt"), \
+                              spline = False):
+    """Resistance (ohms) to temperature (K) calibration from a celsius/ohms table"""
+    celsius, ohms = load_table(path)
+    return Calibration(ohms, celsius + 273.15, spline)
+
+diode_calibration = Calibration(therm_voltages, therm_temps)
+platinum_calibration = Calibration(plat_cal_ohms, plat_cal_kelvin)
+
 def resistivity(type, T):
         return 0
 
 def temperature_from_voltage(V):
-        return interp(V, therm_voltages_r, therm_temps_r)
+        return diode_calibration(V)
 
 def voltage_from_temperature(T):
-        return interp(T, therm_temps, therm_voltages)
+        return diode_calibration.inverse()(T)
 
 def temperature_from_resistance(R):
-        return interp(R, plat_cal_ohms, plat_cal_kelvin)
+        return platinum_calibration(R)
 
 def resistance_from_temperature(T):
-        return interp(T, plat_cal_kelvin, plat_cal_ohms)
+        return platinum_calibration.inverse()(T)
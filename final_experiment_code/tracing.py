@@ -0,0 +1,185 @@
+# TRACING.py
+# Opt-in timing of every GPIB transaction and of the phases of a run, exported
+# as per-command latency histograms and a Chrome trace (chrome://tracing or
+# ui.perfetto.dev) timeline
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+import numpy
+
+def command_head(command):
+    """The command word a transaction is filed under, e.g. "SNAP" for "SNAP ? 3, 4" """
+    return command.strip().split(" ")[0].upper()
+
+class Span(object):
+    def __init__(self, tracer, name, category, lane, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.lane = lane
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.record(self.name, self.category, self.start, time.time(), self.lane, self.args)
+        return False
+
+class NoSpan(object):
+    """Stands in for a Span when nothing is being traced"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+no_span = NoSpan()
+
+class Tracer(object):
+    """Collects timed events from any number of threads. Instrument transactions
+    are filed under their address ("lane") and command head, the phases of a run
+    under the thread or rig running them."""
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def record(self, name, category, start, end, lane = None, args = None):
+        if lane is None:
+            lane = threading.current_thread().name
+        with self.lock:
+            self.events.append((name, category, lane, start, end, args or {}))
+
+    def span(self, name, category = "phase", lane = None, **args):
+        """Context manager timing the block it wraps, filed under lane (by
+        default the name of the current thread)"""
+        return Span(self, name, category, lane, args)
+
+    def latencies(self):
+        """Durations (s) of the instrument transactions by (address, command head)"""
+        latencies = defaultdict(list)
+        with self.lock:
+            for name, category, lane, start, end, args in self.events:
+                if category == "gpib":
+                    latencies[(lane, name)].append(end - start)
+        return dict((key, numpy.array(values)) for key, values in latencies.items())
+
+    def histograms(self, bins = None):
+        """Latency histogram of every (address, command head) as (counts, edges),
+        on logarithmic bins from 100 us to 100 s by default"""
+        if bins is None:
+            bins = numpy.logspace(-4, 2, 25)
+        return dict((key, numpy.histogram(values, bins)) for key, values in self.latencies().items())
+
+    def phase_totals(self):
+        totals = defaultdict(float)
+        with self.lock:
+            for name, category, lane, start, end, args in self.events:
+                if category == "phase":
+                    totals[name] += end - start
+        return dict(totals)
+
+    def report(self):
+        """Text table of the transactions, slowest total first, and of the time
+        spent in each phase"""
+        rows = sorted(self.latencies().items(), key = lambda item: item[1].sum(), reverse = True)
+        lines = ["{a:<18} {h:<16} {n:>7} {t:>9} {m:>9} {p:>9} {x:>9}".format( \
+            a = "address", h = "command", n = "count", t = "total s", m = "mean ms", p = "p95 ms", x = "max ms")]
+        for (address, head), values in rows:
+            lines.append("{a:<18} {h:<16} {n:7d} {t:9.1f} {m:9.2f} {p:9.2f} {x:9.2f}".format( \
+                a = address, h = head, n = len(values), t = values.sum(), m = 1e3*values.mean(), \
+                p = 1e3*numpy.percentile(values, 95), x = 1e3*values.max()))
+        for name, total in sorted(self.phase_totals().items(), key = lambda item: item[1], reverse = True):
+            lines.append("phase {n:<29} {t:9.1f}".format(n = name, t = total))
+        return "\n".join(lines)
+
+    def write_histograms(self, path):
+        """Writes the latency histograms as JSON, one entry per address and
+        command head with the bin edges (s) and counts"""
+        entries = [{"address": address, "command": head, "edges": edges.tolist(), "counts": counts.tolist()} \
+                   for (address, head), (counts, edges) in sorted(self.histograms().items())]
+        with open(path, 'w') as f:
+            json.dump(entries, f, indent = 1)
+
+    def write_chrome_trace(self, path):
+        """Writes the events in the Chrome trace event format, one track per
+        instrument address and per thread running phases"""
+        with self.lock:
+            events = list(self.events)
+        origin = min(start for name, category, lane, start, end, args in events) if events else 0
+        lanes = sorted(set(event[2] for event in events))
+        trace = [{"name": "thread_name", "ph": "M", "pid": 1, "tid": i, "args": {"name": lane}} \
+                 for i, lane in enumerate(lanes)]
+        for name, category, lane, start, end, args in events:
+            trace.append({"name": name, "cat": category, "ph": "X", "pid": 1, "tid": lanes.index(lane), \
+                          "ts": 1e6*(start - origin), "dur": 1e6*(end - start), "args": args})
+        with open(path, 'w') as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+class TracedDevice(object):
+    """Wraps a VISA instrument, recording every write, read and query in tracer"""
+    def __init__(self, device, address, tracer):
+        self.device = device
+        self.address = address
+        self.tracer = tracer
+
+    def transaction(self, name, call, *args):
+        start = time.time()
+        try:
+            return call(*args)
+        finally:
+            self.tracer.record(name, "gpib", start, time.time(), self.address, \
+                               {"command": args[0]} if args else None)
+
+    def write(self, command):
+        return self.transaction(command_head(command), self.device.write, command)
+
+    def read(self):
+        return self.transaction("READ", self.device.read)
+
+    def read_raw(self):
+        return self.transaction("READ", self.device.read_raw)
+
+    def ask(self, command):
+        return self.transaction(command_head(command), self.device.ask, command)
+
+    def query(self, command):
+        return self.transaction(command_head(command), self.device.query, command)
+
+    def ask_for_values(self, command):
+        return self.transaction(command_head(command), self.device.ask_for_values, command)
+
+    def __getattr__(self, name):
+        return getattr(self.device, name)
+
+class TracedResourceManager(object):
+    """Resource manager handing out TracedDevices, whose lanes are prefixed with
+    name when given to tell rigs on the same addresses apart"""
+    def __init__(self, resource_manager, tracer, name = None):
+        self.resource_manager = resource_manager
+        self.tracer = tracer
+        self.name = name
+
+    def lane(self, address):
+        return address if self.name is None else "{n} {a}".format(n = self.name, a = address)
+
+    def get_instrument(self, address):
+        return TracedDevice(self.resource_manager.get_instrument(address), self.lane(address), self.tracer)
+
+    def open_resource(self, address):
+        return TracedDevice(self.resource_manager.open_resource(address), self.lane(address), self.tracer)
+
+    def __getattr__(self, name):
+        return getattr(self.resource_manager, name)
+
+def export(tracer, directory):
+    """Writes TRACE.json, the latency histograms as LATENCY.json and the LATENCY
+    report into directory"""
+    tracer.write_chrome_trace(os.path.join(directory, "TRACE.json"))
+    tracer.write_histograms(os.path.join(directory, "LATENCY.json"))
+    with open(os.path.join(directory, "LATENCY"), 'w') as f:
+        f.write(tracer.report() + "\n")
@@ -0,0 +1,216 @@
+# UNCERTAINTY.py
+# Monte Carlo propagation of thermometer, calibration table and lock-in noise
+# through the diode calibration and the critical fits, thousands of resamples at
+# a time as arrays rather than one fit per loop iteration
+import sys
+
+import numpy
+
+import fitting
+import runstore
+import tempandres
+
+# scatter of one averaged diode reading (V), about the 34401A at 1 NPLC over
+# thermometer_samples readings
+voltage_noise = 1e-5
+
+# scatter (K) of each temperature in the diode table about the true curve
+table_error = 0.05
+
+# fractional scatter of a lock-in reading when the run did not record its own
+# standard errors ("R2 Error" etc.)
+signal_noise = 1e-3
+
+def perturbed_tables(calibration, resamples, error = table_error, random = numpy.random):
+    """resamples copies of the table values (y) of a tempandres.Calibration,
+    each knot scattered independently by error"""
+    return calibration.y + error*random.standard_normal((resamples, len(calibration.y)))
+
+def interpolate_tables(x, knots, tables):
+    """Linear interpolation of each row of x through the matching row of tables,
+    all on the same sorted knots, clamped to the ends like numpy.interp"""
+    x = numpy.clip(x, knots[0], knots[-1])
+    i = numpy.clip(numpy.searchsorted(knots, x) - 1, 0, len(knots) - 2)
+    t = (x - knots[i])/(knots[i + 1] - knots[i])
+    rows = numpy.arange(len(tables))[:, numpy.newaxis]
+    return (1 - t)*tables[rows, i] + t*tables[rows, i + 1]
+
+def resample_temperatures(T, resamples, voltage_error = voltage_noise, calibration_error = table_error, \
+                          calibration = tempandres.diode_calibration, random = numpy.random):
+    """Temperatures T read again resamples times through a scattered copy of the
+    calibration from diode voltages with scattered readings, an array of shape
+    (resamples, len(T))"""
+    V = calibration.inverse()(numpy.asarray(T, dtype = float))
+    V = V + voltage_error*random.standard_normal((resamples, len(V)))
+    return interpolate_tables(V, calibration.x, perturbed_tables(calibration, resamples, calibration_error, random))
+
+def resample_signal(y, error, resamples, random = numpy.random):
+    """resamples copies of the lock-in readings y scattered by error, which may
+    be one value or one per reading"""
+    return y + error*random.standard_normal((resamples, len(y)))
+
+def bootstrap(resamples, points, random = numpy.random):
+    """Indices drawing points of points with replacement, resamples times"""
+    return random.randint(0, points, (resamples, points))
+
+def fit_resamples(T, y, model = "curie", p0 = None, iterations = 1000, xtol = 1e-8, ftol = 1e-10):
+    """Fits model to every row of T and y at once by Levenberg-Marquardt steps
+    taken on the whole stack, starting each from p0 (by default the fit to the
+    first row). A row has converged once a step changes its parameters by less
+    than xtol or its cost by less than ftol, both relative, and drops out of
+    the later steps. Returns the parameters, shape (rows, parameters), with NaN
+    for rows that did not converge within iterations steps."""
+    function, names, inverted = fitting.models[model]
+    if p0 is None:
+        order = numpy.argsort(T[0])
+        row = fitting.fit_window(T[0][order], y[0][order], T[0].min(), T[0].max(), model)
+        if row.get("Status") != "ok":
+            return numpy.full((len(T), len(names)), numpy.nan)
+        p0 = [row[name] for name in names]
+    if inverted:
+        y = 1.0/y
+    # steps are taken in units of p0 so amplitudes of 1e-6 V and Tc near 100 K
+    # are on the same footing
+    scale = numpy.maximum(numpy.abs(p0), 1e-12)
+    u = numpy.tile(numpy.asarray(p0, dtype = float)/scale, (len(T), 1))
+    # Tc has to stay below every point for the power law to be defined
+    ceiling = (T.min(1) - 1e-6*(T.max(1) - T.min(1)))/scale[1]
+    y_scale = numpy.abs(y).mean(1)[:, numpy.newaxis]
+
+    def residuals(u, rows):
+        with numpy.errstate(invalid = 'ignore', divide = 'ignore', over = 'ignore'):
+            return (function(T[rows], *(u*scale).T[:, :, numpy.newaxis]) - y[rows])/y_scale[rows]
+
+    def cost(r):
+        c = (r**2).sum(1)
+        return numpy.where(numpy.isfinite(c), c, numpy.inf)
+
+    everything = numpy.arange(len(T))
+    r = residuals(u, everything)
+    current = cost(r)
+    damping = numpy.full(len(T), 1e-3)
+    converged = ~numpy.isfinite(current)
+    for iteration in range(iterations):
+        rows = numpy.flatnonzero(~converged)
+        if not len(rows):
+            break
+        J = numpy.empty((len(rows), r.shape[1], len(names)))
+        for k in range(len(names)):
+            shifted = u[rows].copy()
+            shifted[:, k] += 1e-7
+            J[:, :, k] = (residuals(shifted, rows) - r[rows])/1e-7
+        JTJ = numpy.einsum('nmk,nml->nkl', J, J)
+        gradient = numpy.einsum('nmk,nm->nk', J, r[rows])
+        diagonal = numpy.einsum('nkk->nk', JTJ)
+        A = JTJ + (damping[rows, numpy.newaxis]*numpy.maximum(diagonal, 1e-12))[:, :, numpy.newaxis]*numpy.eye(len(names))
+        A[~numpy.isfinite(A).all((1, 2))] = numpy.eye(len(names))
+        trial = u[rows] - numpy.linalg.solve(A, numpy.nan_to_num(gradient)[:, :, numpy.newaxis])[:, :, 0]
+        trial[:, 1] = numpy.minimum(trial[:, 1], ceiling[rows])
+        r_trial = residuals(trial, rows)
+        trial_cost = cost(r_trial)
+        better = trial_cost < current[rows]
+        step = numpy.abs(trial - u[rows]).max(1)
+        converged[rows] = (step <= xtol*(numpy.abs(u[rows]).max(1) + xtol)) | \
+                          (better & (current[rows] - trial_cost <= ftol*current[rows]))
+        accepted = rows[better]
+        u[accepted] = trial[better]
+        r[accepted] = r_trial[better]
+        current[accepted] = trial_cost[better]
+        damping[rows] = numpy.clip(numpy.where(better, damping[rows]/3, damping[rows]*2), 1e-12, 1e12)
+    p = u*scale
+    p[~converged | ~numpy.isfinite(current)] = numpy.nan
+    return p
+
+def load_window(run_path, frequency, signal, t_min, t_max):
+    """Temperatures, signal and its recorded standard error (or None) of the
+    points of a COLUMNS run store inside the window, sorted by temperature. All
+    are empty if the run did not record that frequency."""
+    names = runstore.frequency_columns(run_path, frequency)
+    if names is None or signal not in names:
+        return numpy.empty(0), numpy.empty(0), None
+    wanted = [names[key] for key in ("Temperature", signal, signal + " Error") if key in names]
+    columns = runstore.open_run(run_path, wanted)
+    T = numpy.array(columns[names["Temperature"]])
+    y = numpy.array(columns[names[signal]])
+    error = numpy.array(columns[names[signal + " Error"]]) if signal + " Error" in names else None
+    keep = numpy.isfinite(T) & numpy.isfinite(y) & (T >= t_min) & (T <= t_max)
+    order = numpy.argsort(T[keep])
+    return T[keep][order], y[keep][order], error[keep][order] if error is not None else None
+
+def simulate(T, y, error, resamples, model = "curie", resample_points = True, voltage_error = voltage_noise, \
+             calibration_error = table_error, random = numpy.random):
+    """Fitted parameters of resamples scattered copies of one curve: the
+    temperatures through resample_temperatures, the signal by its error (by
+    default signal_noise of each reading) and, with resample_points, the points
+    themselves drawn with replacement. Returns an array (resamples, parameters)."""
+    if error is None:
+        error = signal_noise*numpy.abs(y)
+    T_samples = resample_temperatures(T, resamples, voltage_error, calibration_error, random = random)
+    y_samples = resample_signal(y, numpy.where(numpy.isfinite(error), error, signal_noise*numpy.abs(y)), \
+                                resamples, random)
+    if resample_points:
+        rows = numpy.arange(resamples)[:, numpy.newaxis]
+        indices = bootstrap(resamples, len(T), random)
+        T_samples, y_samples = T_samples[rows, indices], y_samples[rows, indices]
+    # the fits are started from the fit to the curve as measured
+    function, names, inverted = fitting.models[model]
+    row = fitting.fit_window(T, y, T[0], T[-1], model)
+    if row.get("Status") != "ok":
+        return numpy.full((resamples, len(names)), numpy.nan)
+    return fit_resamples(T_samples, y_samples, model, [row[name] for name in names])
+
+def confidence_intervals(samples, names, level = 0.68):
+    """Median and central level interval of each parameter over the resamples
+    that converged, as "<name>", "<name> Low" and "<name> High" """
+    finite = samples[numpy.isfinite(samples).all(1)]
+    row = {"Resamples": len(samples), "Converged": len(finite), "Level": level}
+    for k, name in enumerate(names):
+        if len(finite):
+            row[name], row[name + " Low"], row[name + " High"] = \
+                numpy.percentile(finite[:, k], [50, 50*(1 - level), 50*(1 + level)])
+        else:
+            row[name] = row[name + " Low"] = row[name + " High"] = numpy.nan
+    return row
+
+def temperature_intervals(T, resamples = 2000, level = 0.68, voltage_error = voltage_noise, \
+                          calibration_error = table_error, random = numpy.random):
+    """Lower and upper ends of the central level interval of each recorded
+    temperature T from thermometer noise and calibration table scatter"""
+    samples = resample_temperatures(T, resamples, voltage_error, calibration_error, random = random)
+    return numpy.percentile(samples, [50*(1 - level), 50*(1 + level)], axis = 0)
+
+def simulate_job(job):
+    run_path, frequency, signal, (t_min, t_max), model, resamples, seed, options = job
+    T, y, error = load_window(run_path, frequency, signal, t_min, t_max)
+    if len(T) <= len(fitting.models[model][1]):
+        return numpy.full((resamples, len(fitting.models[model][1])), numpy.nan)
+    return simulate(T, y, error, resamples, model, random = numpy.random.RandomState(seed), **options)
+
+def batch_intervals(run_paths, windows, frequencies = (1, 2, 4, 8), signal = "R", model = "curie", \
+                    resamples = 2000, level = 0.68, chunk = 500, processes = None, seed = None, **options):
+    """Confidence intervals of the fitted parameters for every combination of
+    run store, frequency and (t_min, t_max) window, as fitting.batch_fit rows.
+    The resamples of each fit are simulated in chunks spread over a process pool
+    (processes = 1 simulates in this process); options go to simulate."""
+    combinations = [(path, f, tuple(w)) for path in run_paths for f in frequencies for w in windows]
+    sizes = [min(chunk, resamples - start) for start in range(0, resamples, chunk)]
+    seeds = numpy.random.RandomState(seed).randint(0, 2**31 - 1, len(combinations)*len(sizes))
+    jobs = [(path, f, signal, w, model, size, seeds[i*len(sizes) + j], options) \
+            for i, (path, f, w) in enumerate(combinations) for j, size in enumerate(sizes)]
+    results = fitting.pool_map(simulate_job, jobs, processes)
+    rows = []
+    for i, (path, f, (t_min, t_max)) in enumerate(combinations):
+        samples = numpy.concatenate(results[i*len(sizes):(i + 1)*len(sizes)])
+        row = confidence_intervals(samples, fitting.models[model][1], level)
+        row.update({"Run": path, "Frequency": f, "Signal": signal, "Model": model, \
+                    "Window Min": t_min, "Window Max": t_max})
+        rows.append(row)
+    return rows
+
+if __name__ == "__main__":
+    # uncertainty.py OUTPUT.csv T_MIN T_MAX WINDOW_WIDTH WINDOW_STEP RESAMPLES COLUMNS_DIRECTORY ...
+    arguments = sys.argv[1:]
+    windows = fitting.sliding_windows(*[float(a) for a in arguments[1:5]])
+    rows = batch_intervals(arguments[6:], windows, resamples = int(arguments[5]))
+    fitting.write_table(arguments[0], rows)
+    print "{n} intervals written to {p}".format(n = len(rows), p = arguments[0])